@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the permission check hot paths of django-rubberstamp.
+
+Builds a synthetic dataset in a scratch database and reports, for each
+operation, the queries per call, the p50/p99 latency and the peak memory use
+of the process. Run from the root of the repository, e.g.::
+    
+    python benchmarks/run.py
+    python benchmarks/run.py --users 10000 --groups 500 --assigned 1000000
+    python benchmarks/run.py --engine postgresql_psycopg2 --name rubberstamp_bench
+    python benchmarks/run.py --explain
+
+By default a fresh SQLite database file is created (and removed afterwards).
+Any other database given with ``--engine`` and ``--name`` is used as is, and
+its tables are expected not to exist yet.
+"""
+
+import os
+import sys
+import random
+import resource
+import datetime
+from optparse import OptionParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def get_options():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--engine', default='sqlite3',
+        help='Django database backend to use (default: sqlite3).')
+    parser.add_option('--name', default=None,
+        help='Database name (default: a temporary SQLite file).')
+    parser.add_option('--user', default='', help='Database user.')
+    parser.add_option('--password', default='', help='Database password.')
+    parser.add_option('--host', default='', help='Database host.')
+    parser.add_option('--port', default='', help='Database port.')
+    parser.add_option('--users', type='int', default=1000,
+        help='Number of users (default: 1000).')
+    parser.add_option('--groups', type='int', default=50,
+        help='Number of groups (default: 50).')
+    parser.add_option('--memberships', type='int', default=3,
+        help='Number of groups each user belongs to (default: 3).')
+    parser.add_option('--permissions', type='int', default=20,
+        help='Number of AppPermissions (default: 20).')
+    parser.add_option('--content-types', type='int', default=5,
+        help='Number of extra content types each permission applies to '
+            '(default: 5).')
+    parser.add_option('--objects', type='int', default=1000,
+        help='Number of target objects (default: 1000).')
+    parser.add_option('--assigned', type='int', default=10000,
+        help='Number of AssignedPermission rows, 1k to 10M (default: 10000).')
+    parser.add_option('--calls', type='int', default=200,
+        help='Number of calls measured per operation (default: 200).')
+    parser.add_option('--seed', type='int', default=0,
+        help='Random seed (default: 0).')
+    parser.add_option('--cache-backend', default=None,
+        help='Django cache URI for RUBBERSTAMP_CACHE_BACKEND, e.g. locmem:// '
+            '(default: none).')
+    parser.add_option('--explain', action='store_true', default=False,
+        help='Print the query plans of the hot queries instead of timing.')
+    (options, args) = parser.parse_args()
+    return options
+
+
+def configure(options):
+    from django.conf import settings
+    
+    name = options.name
+    if name is None:
+        if options.engine != 'sqlite3':
+            sys.exit('--name is required for %s.' % options.engine)
+        name = os.path.abspath('rubberstamp_bench.sqlite')
+        if os.path.exists(name):
+            os.remove(name)
+        options.temporary_db = name
+    settings.configure(
+        DEBUG=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.%s' % options.engine,
+                'NAME': name,
+                'USER': options.user,
+                'PASSWORD': options.password,
+                'HOST': options.host,
+                'PORT': options.port,
+            },
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'rubberstamp',
+            'rubberstamp.tests.testapp',
+        ),
+        AUTHENTICATION_BACKENDS=(
+            'rubberstamp.backends.AppPermissionBackend',
+        ),
+        RUBBERSTAMP_CACHE_BACKEND=options.cache_backend,
+    )
+
+
+def insert_in_chunks(model, rows, size=10000):
+    from django.db import transaction
+    from rubberstamp.utils import bulk_insert
+    
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            bulk_insert(model, chunk)
+            transaction.commit_unless_managed()
+            chunk = []
+    bulk_insert(model, chunk)
+    transaction.commit_unless_managed()
+
+
+def coprime_stride(total):
+    """Returns a stride which visits every number below total once."""
+    
+    def gcd(a, b):
+        while b:
+            (a, b) = (b, a % b)
+        return a
+    
+    stride = 7919
+    while gcd(total, stride) != 1:
+        stride += 2
+    return stride
+
+
+def generate(options):
+    """
+    Fills the database with the synthetic dataset, and returns a dict of the
+    ids of the generated rows.
+    """
+    
+    from django.core.management import call_command
+    from django.contrib.auth.models import User, Group
+    from django.contrib.contenttypes.models import ContentType
+    from rubberstamp.models import AppPermission, AssignedPermission
+    from rubberstamp.tests.testapp.models import TestModel
+    
+    call_command('syncdb', interactive=False, verbosity=0)
+    now = datetime.datetime.now()
+    
+    insert_in_chunks(Group, ({
+        'id': i, 'name': 'group%d' % i,
+    } for i in range(1, options.groups + 1)))
+    insert_in_chunks(User, ({
+        'id': i, 'username': 'user%d' % i, 'first_name': '', 'last_name': '',
+        'email': '', 'password': '!', 'is_staff': False, 'is_active': True,
+        'is_superuser': False, 'last_login': now, 'date_joined': now,
+    } for i in range(1, options.users + 1)))
+    memberships = min(options.memberships, options.groups)
+    insert_in_chunks(User.groups.through, ({
+        'user_id': u, 'group_id': (u + m) % options.groups + 1,
+    } for u in range(1, options.users + 1) for m in range(memberships)))
+    insert_in_chunks(TestModel, ({
+        'id': i, 'name': 'object%d' % i,
+    } for i in range(1, options.objects + 1)))
+    
+    target_ct = ContentType.objects.get_for_model(TestModel)
+    extra_cts = [ContentType.objects.create(
+        app_label='bench', model='model%d' % i, name='model %d' % i)
+        for i in range(options.content_types)]
+    insert_in_chunks(AppPermission, ({
+        'id': i, 'app_label': 'testapp', 'codename': 'perm%d' % i,
+        'description': 'Permission %d' % i,
+    } for i in range(1, options.permissions + 1)))
+    insert_in_chunks(AppPermission.content_types.through, ({
+        'apppermission_id': p, 'contenttype_id': ct.id,
+    } for p in range(1, options.permissions + 1)
+        for ct in [target_ct] + extra_cts))
+    
+    # Every assigned row is a distinct (permission, object, principal)
+    # combination, visited in a scattered order; object 0 stands for a
+    # type-level assignment.
+    principals = options.users + options.groups
+    total = options.permissions * (options.objects + 1) * principals
+    assigned = min(options.assigned, total)
+    stride = coprime_stride(total)
+    
+    def assigned_rows():
+        for i in range(assigned):
+            j = (i * stride) % total
+            (j, perm) = divmod(j, options.permissions)
+            (principal, obj) = divmod(j, options.objects + 1)
+            row = {
+                'permission_id': perm + 1,
+                'content_type_id': target_ct.id,
+                'object_id': obj or None,
+                'user_id': None,
+                'group_id': None,
+            }
+            if principal < options.users:
+                row['user_id'] = principal + 1
+            else:
+                row['group_id'] = principal - options.users + 1
+            yield row
+    insert_in_chunks(AssignedPermission, assigned_rows())
+    
+    return {
+        'users': list(range(1, options.users + 1)),
+        'objects': list(range(1, options.objects + 1)),
+        'permissions': ['testapp.perm%d' % p
+            for p in range(1, options.permissions + 1)],
+        'target': '%s.%s' % (target_ct.app_label, target_ct.model),
+        'assigned': assigned,
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def measure(name, calls):
+    """
+    Runs each of the given callables, and writes a line with the queries per
+    call, latency percentiles and peak memory for the operation.
+    """
+    
+    from django.db import connection, reset_queries
+    
+    timings = []
+    queries = 0
+    for call in calls:
+        reset_queries()
+        start = default_timer()
+        call()
+        timings.append(default_timer() - start)
+        queries += len(connection.queries)
+    reset_queries()
+    # ru_maxrss is in kilobytes on Linux and bytes on Mac OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss = maxrss // 1024
+    sys.stdout.write('%-28s %8d %10.2f %10.3f %10.3f %12d\n' % (
+        name,
+        len(calls),
+        float(queries) / len(calls),
+        percentile(timings, 0.5) * 1000,
+        percentile(timings, 0.99) * 1000,
+        maxrss,
+    ))
+
+
+def run_benchmarks(options, data):
+    from django.contrib.auth.models import User
+    from rubberstamp.models import AppPermission
+    from rubberstamp.backends import AppPermissionBackend
+    from rubberstamp.utils import get_permission_targets
+    from rubberstamp.tests.testapp.models import TestModel
+    from rubberstamp.cache import prime_resolution_cache
+    from rubberstamp.tests.testapp import permissions as testapp_permissions
+    import rubberstamp
+    
+    rnd = random.Random(options.seed)
+    backend = AppPermissionBackend()
+    users = dict([(u.id, u) for u in User.objects.filter(
+        id__in=rnd.sample(data['users'], min(len(data['users']), 500)))])
+    objects = dict([(o.id, o) for o in TestModel.objects.filter(
+        id__in=rnd.sample(data['objects'], min(len(data['objects']), 500)))])
+    
+    def fresh(user):
+        # a new instance, without any permissions cached on it
+        return User(**dict([(f.attname, getattr(user, f.attname))
+            for f in User._meta.fields]))
+    
+    def sample():
+        user = users[rnd.choice(list(users))]
+        obj = objects[rnd.choice(list(objects))]
+        perm = rnd.choice(data['permissions'])
+        return (user, obj, perm)
+    
+    def calls(func):
+        return [func(*sample()) for i in range(options.calls)]
+    
+    sys.stdout.write('%d users, %d groups, %d permissions, %d objects, '
+        '%d assigned\n\n' % (options.users, options.groups, options.permissions,
+        options.objects, data['assigned']))
+    sys.stdout.write('%-28s %8s %10s %10s %10s %12s\n' % (
+        'operation', 'calls', 'queries', 'p50 ms', 'p99 ms', 'max rss KB'))
+    
+    # resolve every permission string once, as a running process would
+    prime_resolution_cache()
+    
+    measure('has_perm (type, cold)', calls(lambda u, o, p:
+        lambda: backend.has_perm(fresh(u), '%s.%s' % (p, data['target']))))
+    measure('has_perm (object, cold)', calls(lambda u, o, p:
+        lambda: backend.has_perm(fresh(u), p, o)))
+    warm = dict([(u.id, fresh(u)) for u in users.values()])
+    for user in warm.values():
+        backend.has_module_perms(user, 'testapp')
+    measure('has_perm (object, warm)', calls(lambda u, o, p:
+        lambda: backend.has_perm(warm[u.id], p, o)))
+    measure('has_module_perms (cold)', calls(lambda u, o, p:
+        lambda: backend.has_module_perms(fresh(u), 'testapp')))
+    measure('check_perms (10, cold)', calls(lambda u, o, p:
+        lambda: backend.check_perms(fresh(u), [(p, o)] * 5
+            + [('%s.%s' % (p, data['target']), None)] * 5)))
+    measure('get_all_permissions (cold)', calls(lambda u, o, p:
+        lambda: backend.get_all_permissions(fresh(u))))
+    measure('get_all_permissions (obj)', calls(lambda u, o, p:
+        lambda: backend.get_all_permissions(fresh(u), o)))
+    measure('get_permission_targets', calls(lambda u, o, p:
+        lambda: list(get_permission_targets(
+            '%s.%s' % (p, data['target']), u)[:50])))
+    measure('assign', calls(lambda u, o, p:
+        lambda: AppPermission.objects.assign(p, u, obj=o)))
+    
+    original = testapp_permissions.permissions
+    testapp_permissions.permissions = [
+        (p.split('.', 1)[1], 'Permission', TestModel)
+        for p in data['permissions']]
+    try:
+        measure('autodiscover', [rubberstamp.autodiscover] * min(options.calls, 20))
+    finally:
+        testapp_permissions.permissions = original
+
+
+def explain(options, data):
+    """Writes the query plans of the hot permission queries."""
+    
+    from django.db import connection
+    from django.db.models import Q
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from rubberstamp.models import AppPermission, AssignedPermission
+    from rubberstamp.utils import get_perm_q_for_user, get_permission_targets
+    from rubberstamp.tests.testapp.models import TestModel
+    
+    user = User.objects.get(pk=data['users'][0])
+    permission = '%s.%s' % (data['permissions'][0], data['target'])
+    (perm, ct) = AppPermission.objects.get_permission_and_content_type(permission)
+    querysets = [
+        ('permissions of a user', AssignedPermission.objects.filter(
+            get_perm_q_for_user(user)).values_list(
+                'permission', 'content_type', 'object_id')),
+        ('permission for an object', AssignedPermission.objects.filter(
+            Q(permission=perm, content_type=ct, object_id=data['objects'][0])
+            & get_perm_q_for_user(user))),
+        ('permission for the type', AssignedPermission.objects.filter(
+            Q(permission=perm, content_type=ct, object_id=None)
+            & get_perm_q_for_user(user))),
+        ('get_permission_targets', get_permission_targets(permission, user)),
+    ]
+    if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    for (name, qs) in querysets:
+        (sql, params) = qs.query.get_compiler(qs.db).as_sql()
+        cursor.execute(prefix + sql, params)
+        sys.stdout.write('-- %s\n%s\n' % (name, sql % tuple(params)))
+        for row in cursor.fetchall():
+            sys.stdout.write('    %s\n' % ' '.join([str(c) for c in row]))
+        sys.stdout.write('\n')
+
+
+def main():
+    options = get_options()
+    options.temporary_db = None
+    configure(options)
+    try:
+        data = generate(options)
+        if options.explain:
+            explain(options, data)
+        else:
+            run_benchmarks(options, data)
+    finally:
+        if options.temporary_db and os.path.exists(options.temporary_db):
+            os.remove(options.temporary_db)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,95 @@
-from django.db.models import Q
 from django.contrib.contenttypes.models import ContentType
-from rubberstamp.models import AppPermission, AssignedPermission
-from rubberstamp.utils import get_perm_q_for_user
+from rubberstamp.models import AppPermission
+from rubberstamp.cache import get_user_permissions
 from rubberstamp.exceptions import PermissionLookupError
+from rubberstamp.instrumentation import instrumented
+from rubberstamp.utils import get_parent_content_types, iter_permission_parents
 
 
 class AppPermissionBackend(object):
-    """A permission backend to support AppPermission."""
+    """
+    A permission backend to support AppPermission.
+    
+    All of a user's assigned permissions are loaded once and cached on the
+    user instance; the cache is invalidated whenever assigned permissions or
+    group memberships change.
+    
+    A permission assigned for a type counts for every object of it, and one
+    assigned for an object counts for its children (see
+    ``RUBBERSTAMP_PERMISSION_PARENTS``). Permissions implied by an assigned
+    one (see `AppPermission.implies`) count as assigned too.
+    """
     
     supports_object_permissions = True
     supports_anonymous_user = True
     
+    @instrumented('has_perm')
     def has_perm(self, user, perm, obj=None):
         try:
             (perm, ct) = AppPermission.objects.get_permission_and_content_type(perm, obj)
         except PermissionLookupError:
             return False
         
+        return self._check(get_user_permissions(user), perm, ct, obj)
+    
+    @instrumented('check_perms')
+    def check_perms(self, user, checks):
+        """
+        Given a user and a list of `(permission, obj)` pairs, where `obj` may
+        be None for a type-level check, returns a list of whether the user has
+        each permission, in the same order.
+        
+        All checks are answered from one load of the user's permissions
+        (shared with `has_perm`), so a view can make many checks without a
+        round trip to the database for each.
+        """
+        
+        permissions = get_user_permissions(user)
+        results = []
+        for (perm, obj) in checks:
+            try:
+                (perm, ct) = AppPermission.objects.get_permission_and_content_type(perm, obj)
+            except PermissionLookupError:
+                results.append(False)
+                continue
+            results.append(self._check(permissions, perm, ct, obj))
+        return results
+    
+    def _check(self, permissions, perm, ct, obj):
         obj_id = None
         if obj:
-            obj_id = obj.id
+            obj_id = obj.pk
+        if permissions.has_perm(perm.id, ct.id, obj_id):
+            return True
+        if obj_id is None:
+            return False
         
-        q = Q(
-            permission=perm,
-            content_type=ct,
-            object_id=obj_id
-        ) & get_perm_q_for_user(user)
-        return AssignedPermission.objects.filter(q).exists()
+        ct_ids = get_parent_content_types(type(obj))
+        if not [ct_id for ct_id in ct_ids if permissions.index.has_any(perm.id, ct_id)]:
+            # nothing assigned which could be inherited, so no parent is loaded
+            return False
+        for (ct_id, parent_pk) in iter_permission_parents(obj):
+            if permissions.has_perm(perm.id, ct_id, parent_pk):
+                return True
+        return False
     
+    @instrumented('has_module_perms')
     def has_module_perms(self, user, app_label):
-        q = Q(permission__app_label=app_label) & get_perm_q_for_user(user)
-        return AssignedPermission.objects.filter(q).exists()
+        return get_user_permissions(user).has_module_perms(app_label)
     
+    @instrumented('get_all_permissions')
     def get_all_permissions(self, user, obj=None):
-        q = get_perm_q_for_user(user)
+        """
+        Returns the set of permission strings, in the full
+        `'app_label.codename.target_app.target_model'` form, which the user
+        has. If an object is given, only returns those which apply to it,
+        including permissions assigned for its type.
+        """
+        
         if obj:
-            q = q & Q(
-                content_type=ContentType.objects.get_for_model(obj),
-                object_id=obj.id
-            )
-        perm_ids = AssignedPermission.objects.filter(q).values_list('permission')
-        perms = AppPermission.objects.filter(id__in=perm_ids)
-        return set(['%s.%s' % (p.app_label, p.codename) for p in perms])
+            return get_user_permissions(user).get_all_permissions(
+                ContentType.objects.get_for_model(obj).id, obj.pk)
+        return get_user_permissions(user).get_all_permissions()
     
     def authenticate(self, **credentials):
         return None
@@ -0,0 +1,694 @@
+import numbers
+import random
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache, get_cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.loading import get_model
+from django.utils.encoding import force_unicode
+
+from rubberstamp.utils import get_perm_q_for_user
+from rubberstamp.instrumentation import record_cache_hit, record_cache_miss
+
+
+CACHE_ATTR = '_rubberstamp_perm_cache'
+RESOLUTION_CACHE_SIZE = getattr(settings, 'RUBBERSTAMP_RESOLUTION_CACHE_SIZE', 10000)
+
+# bumped whenever assigned permissions (or group memberships) change, so any
+# per-user cache loaded before the change is reloaded on next use
+_generation = 0
+# likewise, bumped only when group memberships change
+_membership_generation = 0
+GROUP_IDS_ATTR = '_rubberstamp_group_ids'
+
+PERMISSION_TREE_CACHE_KEY = 'rubberstamp.permission_tree'
+
+# keys of the shared cache; entries are keyed by the version of the principal
+# they belong to (and the version of all permissions, for renames), and by the
+# format of their grants
+VERSION_KEY = 'rubberstamp.version.%s'
+ENTRY_KEY = 'rubberstamp.perms.3.%s.%s.%s'
+# versions must outlive the entries keyed by them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+_shared_cache = (None, None)
+# shared cache key of a group entry -> the group's grants
+_group_grants = {}
+GROUP_ROWS_CACHE_SIZE = getattr(settings, 'RUBBERSTAMP_GROUP_ROWS_CACHE_SIZE', 1000)
+# per thread, the (user ids, group ids) changed in a transaction not yet
+# ended, whose entries are invalidated again once it has
+_pending = threading.local()
+
+# the fields of each row of assigned permissions
+PERMISSION_FIELDS = ('permission', 'content_type', 'object_id', 'object_key',
+    'permission__app_label', 'permission__codename',
+    'content_type__app_label', 'content_type__model')
+
+
+def invalidate_permission_cache(**kwargs):
+    """
+    Invalidates every per-user permission cache in this process.
+    
+    Accepts arbitrary keyword arguments so it can be connected directly to
+    model signals.
+    """
+    
+    global _generation
+    _generation += 1
+
+
+def invalidate_group_cache(**kwargs):
+    """
+    Invalidates every cached list of a user's group ids in this process.
+    
+    Accepts arbitrary keyword arguments so it can be connected directly to
+    model signals.
+    """
+    
+    global _membership_generation
+    _membership_generation += 1
+
+
+def get_user_group_ids(user):
+    """
+    Returns a list of the ids of the groups the given user belongs to,
+    loading them on first use and caching them on the user instance.
+    """
+    
+    cached = getattr(user, GROUP_IDS_ATTR, None)
+    if cached is None or cached[0] != _membership_generation:
+        generation = _membership_generation
+        group_ids = list(user.groups.values_list('id', flat=True))
+        cached = (generation, group_ids)
+        setattr(user, GROUP_IDS_ATTR, cached)
+    return cached[1]
+
+
+# integer object ids are PositiveIntegerFields, so fit in 4 bytes
+ID_TYPECODE = array('I').itemsize >= 4 and 'I' or 'L'
+
+
+def _encode(perm_id, ct_id):
+    """Encodes a permission and content type id pair as a single integer."""
+    
+    return (perm_id << 32) | ct_id
+
+
+class PermissionIndex(object):
+    """
+    A compact index of assigned permissions, for fast membership tests.
+    
+    Type-level assignments are kept as a set of integer-encoded (permission,
+    content type) pairs, and object-level assignments as a sorted array of
+    object ids per pair, searched by bisection. Objects with other primary
+    keys are kept as a set of their keys, as text, per pair.
+    """
+    
+    def __init__(self, rows):
+        """
+        Builds the index from `(perm_id, ct_id, obj_id)` rows, where `obj_id`
+        is an integer id, a text key, or None for the type.
+        """
+        
+        self.types = set()
+        object_ids = {}
+        self.keys = {}
+        for (perm_id, ct_id, obj_id) in rows:
+            key = _encode(perm_id, ct_id)
+            if obj_id is None:
+                self.types.add(key)
+            elif isinstance(obj_id, numbers.Integral):
+                object_ids.setdefault(key, set()).add(obj_id)
+            else:
+                self.keys.setdefault(key, set()).add(obj_id)
+        self.objects = dict([(key, array(ID_TYPECODE, sorted(ids)))
+            for (key, ids) in object_ids.items()])
+    
+    def has_type(self, perm_id, ct_id):
+        """Returns whether the permission is assigned for the type."""
+        
+        return _encode(perm_id, ct_id) in self.types
+    
+    def has_object(self, perm_id, ct_id, obj_id):
+        """
+        Returns whether the permission is assigned for the object itself,
+        given its primary key.
+        """
+        
+        key = _encode(perm_id, ct_id)
+        if isinstance(obj_id, numbers.Integral):
+            ids = self.objects.get(key)
+            if ids:
+                i = bisect_left(ids, obj_id)
+                if i < len(ids) and ids[i] == obj_id:
+                    return True
+        # other keys, including integers which don't fit object ids
+        return force_unicode(obj_id) in self.keys.get(key, ())
+    
+    def has_any(self, perm_id, ct_id):
+        """Returns whether the permission is assigned for the type or any object of it."""
+        
+        key = _encode(perm_id, ct_id)
+        return key in self.types or key in self.objects or key in self.keys
+    
+    def object_ids(self, perm_id, ct_id):
+        """Returns the sorted array of object ids the permission is assigned for."""
+        
+        return self.objects.get(_encode(perm_id, ct_id), array(ID_TYPECODE))
+    
+    def memory_footprint(self):
+        """Returns the approximate size of the index in memory, in bytes."""
+        
+        size = sys.getsizeof(self.types) + sys.getsizeof(self.objects)
+        size += sum([sys.getsizeof(key) for key in self.types])
+        for (key, ids) in self.objects.items():
+            size += sys.getsizeof(key) + sys.getsizeof(ids)
+        size += sys.getsizeof(self.keys)
+        for (key, obj_keys) in self.keys.items():
+            size += sys.getsizeof(key) + sys.getsizeof(obj_keys)
+            size += sum([sys.getsizeof(obj_key) for obj_key in obj_keys])
+        return size
+
+
+class UserPermissions(object):
+    """
+    The permissions assigned to a user, directly and through groups, loaded
+    with a single query (or from the shared cache, if configured) and
+    answered from memory afterwards.
+    """
+    
+    def __init__(self, user):
+        self.generation = _generation
+        # (permission id, content type id) ->
+        # 'app_label.codename.target_app.target_model'
+        self.names = {}
+        self.app_labels = set()
+        self._all_permissions = None
+        if user.is_anonymous():
+            # anonymous users have no perms
+            self.index = PermissionIndex([])
+            return
+        
+        shared = get_shared_cache()
+        if shared is None:
+            all_grants = [get_grants(_get_rows(get_perm_q_for_user(user)))]
+        else:
+            all_grants = get_shared_grants(shared, user)
+        assigned = []
+        for grants in all_grants:
+            for ((perm_id, ct_id), (names, is_type, ids, keys)) in grants.items():
+                (app_label, codename, target_app, target_model) = names
+                # a permission grants those it implies, for the same target if
+                # they apply to it
+                granted = [(perm_id, app_label, codename)] + \
+                    get_implied_permissions(perm_id, ct_id)
+                for (perm_id, app_label, codename) in granted:
+                    if is_type:
+                        assigned.append((perm_id, ct_id, None))
+                    assigned.extend([(perm_id, ct_id, obj_id) for obj_id in ids])
+                    assigned.extend([(perm_id, ct_id, obj_key) for obj_key in keys])
+                    if (perm_id, ct_id) not in self.names:
+                        self.names[(perm_id, ct_id)] = '%s.%s.%s.%s' % (
+                            app_label, codename, target_app, target_model)
+                        self.app_labels.add(app_label)
+        self.index = PermissionIndex(assigned)
+    
+    def has_perm(self, perm_id, ct_id, obj_id=None):
+        """
+        Returns whether the permission is assigned for the type, or for the
+        given object (by itself, or through the type).
+        """
+        
+        if self.index.has_type(perm_id, ct_id):
+            return True
+        return obj_id is not None and self.index.has_object(perm_id, ct_id, obj_id)
+    
+    def has_module_perms(self, app_label):
+        return app_label in self.app_labels
+    
+    def get_all_permissions(self, ct_id=None, obj_id=None):
+        """
+        Returns the set of full permission strings assigned to the user.
+        
+        If a content type and object id are given, only returns those which
+        apply to that object, either for the object itself or for its type.
+        """
+        
+        if ct_id is None:
+            if self._all_permissions is None:
+                self._all_permissions = set(self.names.values())
+            return self._all_permissions
+        return set([
+            name for ((p, ct), name) in self.names.items()
+            if ct == ct_id and (self.index.has_type(p, ct)
+                or self.index.has_object(p, ct, obj_id))
+        ])
+    
+    def memory_footprint(self):
+        """Returns the approximate size of these permissions in memory, in bytes."""
+        
+        size = self.index.memory_footprint() + sys.getsizeof(self.names)
+        for (key, name) in self.names.items():
+            size += sys.getsizeof(key) + sys.getsizeof(name)
+        return size
+
+
+def get_cached_user_permissions(user):
+    """
+    Returns the `UserPermissions` already cached on the given user instance,
+    or None if they have not been loaded (or are out of date).
+    """
+    
+    cached = getattr(user, CACHE_ATTR, None)
+    if cached is None or cached.generation != _generation:
+        return None
+    return cached
+
+
+def get_user_permissions(user):
+    """
+    Returns the `UserPermissions` for the given user, loading them on first
+    use and caching them on the user instance, like Django's `ModelBackend`
+    does with `_perm_cache`.
+    """
+    
+    cached = get_cached_user_permissions(user)
+    if cached is None:
+        record_cache_miss()
+        cached = UserPermissions(user)
+        setattr(user, CACHE_ATTR, cached)
+    else:
+        record_cache_hit()
+    return cached
+
+
+# (permission string, object content type id) -> (AppPermission, ContentType)
+_resolved = {}
+
+
+def get_resolved_permission(permission, obj_ct_id=None):
+    """
+    Returns the cached `(AppPermission, ContentType)` tuple for the given
+    permission string and object content type id, or None if not cached.
+    """
+    
+    resolved = _resolved.get((permission, obj_ct_id))
+    if resolved:
+        record_cache_hit()
+    else:
+        record_cache_miss()
+    return resolved
+
+
+def set_resolved_permission(permission, obj_ct_id, resolved):
+    """Caches the resolution of a permission string."""
+    
+    if len(_resolved) >= RESOLUTION_CACHE_SIZE:
+        # keep the cache bounded; entries are cheap to resolve again
+        _resolved.clear()
+    _resolved[(permission, obj_ct_id)] = resolved
+
+
+def clear_resolution_cache(**kwargs):
+    """
+    Clears all cached permission string resolutions, along with the
+    closure of implied permissions.
+    
+    Accepts arbitrary keyword arguments so it can be connected directly to
+    model signals.
+    """
+    
+    global _implications
+    _resolved.clear()
+    _implications = None
+
+
+# (permission id -> [(implied id, app_label, codename)],
+#  permission id -> ids of the permissions implying it,
+#  implied permission id -> ids of the content types it applies to),
+#  loaded on first use
+_implications = None
+
+
+def _load_implications():
+    """
+    Returns the transitive closure of the permissions each `AppPermission`
+    implies, along with the content types of the implied permissions, loaded
+    with one query for each.
+    """
+    
+    AppPermission = get_model('rubberstamp', 'apppermission')
+    names = {}
+    graph = {}
+    targets = {}
+    for (from_id, to_id, app_label, codename) in AppPermission.implies.through.objects \
+            .values_list('from_apppermission', 'to_apppermission',
+                'to_apppermission__app_label', 'to_apppermission__codename'):
+        names[to_id] = (app_label, codename)
+        graph.setdefault(from_id, []).append(to_id)
+    if names:
+        for (perm_id, ct_id) in AppPermission.content_types.through.objects \
+                .filter(apppermission__in=names.keys()) \
+                .values_list('apppermission', 'contenttype'):
+            targets.setdefault(perm_id, set()).add(ct_id)
+    
+    implied = {}
+    implying = {}
+    for start in graph:
+        seen = set()
+        stack = list(graph[start])
+        while stack:
+            perm_id = stack.pop()
+            if perm_id not in seen and perm_id != start:
+                seen.add(perm_id)
+                stack.extend(graph.get(perm_id, ()))
+        implied[start] = [(perm_id,) + names[perm_id] for perm_id in sorted(seen)]
+        for perm_id in seen:
+            implying.setdefault(perm_id, [perm_id]).append(start)
+    return (implied, implying, targets)
+
+
+def get_implications():
+    """
+    Returns a tuple of three dicts: the first maps permission ids to a list
+    of `(id, app_label, codename)` of the permissions they imply, the second
+    maps permission ids to a list of the ids of the permissions implying
+    them (and their own), and the third maps the ids of implied permissions
+    to the set of ids of the content types they apply to. Loaded on first
+    use, and cached for the life of the process until permissions change.
+    """
+    
+    global _implications
+    if _implications is None:
+        _implications = _load_implications()
+    return _implications
+
+
+def get_implied_permissions(perm_id, ct_id=None):
+    """
+    Returns a list of `(id, app_label, codename)` of the permissions the
+    given permission implies, directly or transitively.
+    
+    If a content type id is given, only returns those which apply to it.
+    """
+    
+    (implied, implying, targets) = get_implications()
+    if ct_id is None:
+        return implied.get(perm_id, [])
+    return [perm for perm in implied.get(perm_id, [])
+        if ct_id in targets.get(perm[0], ())]
+
+
+def get_implying_permission_ids(perm_id):
+    """
+    Returns a list of the ids of the given permission and of every
+    permission which implies it, directly or transitively.
+    """
+    
+    return get_implications()[1].get(perm_id, [perm_id])
+
+
+def prime_resolution_cache():
+    """
+    Fills the resolution cache with every AppPermission and the content types
+    it applies to, using a single query.
+    """
+    
+    AppPermission = get_model('rubberstamp', 'apppermission')
+    links = AppPermission.content_types.through.objects \
+        .select_related('apppermission', 'contenttype')
+    _resolved.clear()
+    for link in links:
+        if len(_resolved) + 3 > RESOLUTION_CACHE_SIZE:
+            break
+        (perm, ct) = (link.apppermission, link.contenttype)
+        short = '%s.%s' % (perm.app_label, perm.codename)
+        full = '%s.%s.%s' % (short, ct.app_label, ct.model)
+        _resolved[(full, None)] = (perm, ct)
+        _resolved[(full, ct.id)] = (perm, ct)
+        if len(perm.codename.split('.')) < 3:
+            # longer codenames could be mistaken for a codename followed by a
+            # content type, so they are left to be resolved on first use
+            _resolved[(short, ct.id)] = (perm, ct)
+
+
+def clear_permission_tree_cache(**kwargs):
+    """
+    Clears the cached result of `rubberstamp.utils.get_permission_tree`.
+    
+    Accepts arbitrary keyword arguments so it can be connected directly to
+    model signals.
+    """
+    
+    cache.delete(PERMISSION_TREE_CACHE_KEY)
+
+
+def _get_rows(q):
+    AssignedPermission = get_model('rubberstamp', 'assignedpermission')
+    return AssignedPermission.objects.filter(q).values_list(*PERMISSION_FIELDS)
+
+
+def get_grants(rows):
+    """
+    Returns the given rows of assigned permissions in the compact form kept
+    in the caches: a dict mapping each `(perm_id, ct_id)` pair to a tuple of
+    the names making up its permission string, whether it is assigned for
+    the type, a sorted array of the ids of the objects it is assigned for and
+    a tuple of the keys of those with other primary keys.
+    """
+    
+    grouped = {}
+    for (perm_id, ct_id, obj_id, obj_key, app_label, codename,
+            target_app, target_model) in rows:
+        pair = (perm_id, ct_id)
+        if pair not in grouped:
+            grouped[pair] = ((app_label, codename, target_app, target_model),
+                [False], set(), set())
+        (names, is_type, ids, keys) = grouped[pair]
+        if obj_id is not None:
+            ids.add(obj_id)
+        elif obj_key is not None:
+            keys.add(obj_key)
+        else:
+            is_type[0] = True
+    return dict([
+        (pair, (names, is_type[0], array(ID_TYPECODE, sorted(ids)), tuple(keys)))
+        for (pair, (names, is_type, ids, keys)) in grouped.items()
+    ])
+
+
+def get_shared_cache():
+    """
+    Returns the cache configured with ``RUBBERSTAMP_CACHE_BACKEND`` (a
+    Django cache URI), shared between processes, or None if not configured.
+    """
+    
+    global _shared_cache
+    backend_uri = getattr(settings, 'RUBBERSTAMP_CACHE_BACKEND', None)
+    if not backend_uri:
+        return None
+    if _shared_cache[0] != backend_uri:
+        _shared_cache = (backend_uri, get_cache(backend_uri))
+    return _shared_cache[1]
+
+
+def _get_versions(shared, principals):
+    """
+    Returns a dict mapping each of the given principals (like ``'user.1'``)
+    to its current version in the shared cache.
+    """
+    
+    keys = dict([(VERSION_KEY % p, p) for p in principals])
+    found = shared.get_many(list(keys.keys()))
+    versions = {}
+    for (key, principal) in keys.items():
+        if key in found:
+            versions[principal] = found[key]
+            continue
+        # start from a random version, so entries cached under an evicted
+        # version can never be mistaken for current ones
+        shared.add(key, random.randint(0, 2 ** 31), VERSION_TIMEOUT)
+        versions[principal] = shared.get(key)
+    return versions
+
+
+def get_shared_grants(shared, user):
+    """
+    Returns a list of the grants (see `get_grants`) of the permissions
+    assigned to the given user, directly and through each of their groups,
+    from the shared cache, loading and caching any missing user or group
+    entries.
+    
+    A user's entry holds their direct assignments and group ids; each group
+    has its own entry, shared by all its members. Group entries are also kept
+    in this process, under the same versioned keys, so a popular group is
+    loaded (and unpickled) once per process and version, rather than once per
+    member.
+    """
+    
+    invalidate_pending()
+    timeout = getattr(settings, 'RUBBERSTAMP_CACHE_TIMEOUT', None)
+    principal = 'user.%s' % user.pk
+    versions = _get_versions(shared, ['all', principal])
+    key = ENTRY_KEY % (principal, versions['all'], versions[principal])
+    entry = shared.get(key)
+    if entry is None:
+        record_cache_miss()
+        entry = (get_grants(_get_rows(Q(user=user))),
+            list(user.groups.values_list('id', flat=True)))
+        shared.set(key, entry, timeout)
+    else:
+        record_cache_hit()
+    (grants, group_ids) = entry
+    all_grants = [grants]
+    if not group_ids:
+        return all_grants
+    
+    versions.update(_get_versions(shared, ['group.%s' % g for g in group_ids]))
+    keys = dict([
+        (ENTRY_KEY % ('group.%s' % g, versions['all'], versions['group.%s' % g]), g)
+        for g in group_ids
+    ])
+    missing = {}
+    fetch = []
+    for (key, group_id) in keys.items():
+        if key in _group_grants:
+            record_cache_hit()
+            all_grants.append(_group_grants[key])
+        else:
+            fetch.append(key)
+    if fetch:
+        entries = shared.get_many(fetch)
+        for key in fetch:
+            if key in entries:
+                record_cache_hit()
+                set_group_grants(key, entries[key])
+                all_grants.append(entries[key])
+            else:
+                record_cache_miss()
+                missing[keys[key]] = []
+    if missing:
+        AssignedPermission = get_model('rubberstamp', 'assignedpermission')
+        for row in AssignedPermission.objects.filter(group__in=list(missing.keys())) \
+                .values_list('group', *PERMISSION_FIELDS):
+            missing[row[0]].append(row[1:])
+        loaded = dict([(key, get_grants(missing[group_id]))
+            for (key, group_id) in keys.items() if group_id in missing])
+        shared.set_many(loaded, timeout)
+        for (key, grants) in loaded.items():
+            set_group_grants(key, grants)
+            all_grants.append(grants)
+    return all_grants
+
+
+def set_group_grants(key, grants):
+    """
+    Keeps a group's grants, under their shared cache key, in this process, so
+    the group's members share one copy of them.
+    """
+    
+    if len(_group_grants) >= GROUP_ROWS_CACHE_SIZE:
+        # keep the cache bounded; entries are cheap to fetch again
+        _group_grants.clear()
+    _group_grants[key] = grants
+
+
+def clear_group_rows_cache():
+    """Clears the grants of groups kept in this process."""
+    
+    _group_grants.clear()
+
+
+def invalidate_shared_cache(user_ids=(), group_ids=(), everyone=False):
+    """
+    Invalidates the shared cache entries of the given users and groups (or of
+    everyone, if `everyone` is true), by incrementing their versions.
+    """
+    
+    shared = get_shared_cache()
+    if shared is None:
+        return
+    principals = ['user.%s' % u for u in user_ids] + ['group.%s' % g for g in group_ids]
+    if everyone:
+        principals.append('all')
+    for principal in principals:
+        try:
+            shared.incr(VERSION_KEY % principal)
+        except ValueError:
+            # no version, so nothing is cached under it
+            pass
+
+
+def invalidate_shared_principal(sender, instance, **kwargs):
+    """
+    Invalidates the shared cache entry of the user or group of the given
+    AssignedPermission, for its ``post_save`` and ``post_delete`` signals.
+    
+    Inside a transaction, the signals are sent before the change is
+    committed, so the entry is invalidated again by `invalidate_pending`
+    once the transaction has ended, without committing it any earlier.
+    """
+    
+    if instance.user_id is not None:
+        (user_ids, group_ids) = ([instance.user_id], [])
+    else:
+        (user_ids, group_ids) = ([], [instance.group_id])
+    invalidate_shared_cache(user_ids=user_ids, group_ids=group_ids)
+    if get_shared_cache() is not None and transaction.is_managed():
+        # the change isn't committed yet, so a concurrent request may still
+        # cache the rows it reads under the new version
+        pending = getattr(_pending, 'principals', None)
+        if pending is None:
+            pending = _pending.principals = (set(), set())
+        pending[0].update(user_ids)
+        pending[1].update(group_ids)
+
+
+def invalidate_pending():
+    """
+    Invalidates the shared cache entries of the users and groups changed in
+    this thread's last transaction, once it has been committed (or rolled
+    back), so that no entry cached from rows read before the commit outlives
+    it. Called before each read of the shared cache.
+    """
+    
+    pending = getattr(_pending, 'principals', None)
+    if pending is None or transaction.is_dirty():
+        return
+    _pending.principals = None
+    invalidate_shared_cache(user_ids=list(pending[0]), group_ids=list(pending[1]))
+
+
+def invalidate_shared_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates the shared cache entries of users whose groups changed, for
+    the ``m2m_changed`` signal of `User.groups`.
+    """
+    
+    if not reverse:
+        # the groups of a single user changed
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_shared_cache(user_ids=[instance.pk])
+    elif action == 'pre_clear':
+        # remember the members of the group, which are gone after clearing
+        instance._rubberstamp_cleared_users = list(
+            instance.user_set.values_list('id', flat=True))
+    elif action == 'post_clear':
+        invalidate_shared_cache(user_ids=getattr(instance, '_rubberstamp_cleared_users', []))
+    elif action in ('post_add', 'post_remove'):
+        invalidate_shared_cache(user_ids=pk_set)
+
+
+def invalidate_shared_permissions(**kwargs):
+    """
+    Invalidates every shared cache entry, e.g. when a permission is renamed.
+    
+    Accepts arbitrary keyword arguments so it can be connected directly to
+    model signals.
+    """
+    
+    invalidate_shared_cache(everyone=True)
@@ -0,0 +1,359 @@
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+
+from django.contrib.contenttypes.models import ContentType
+from rubberstamp.models import AppPermission
+from rubberstamp.cache import clear_resolution_cache, prime_resolution_cache, \
+    clear_permission_tree_cache, invalidate_permission_cache, invalidate_shared_cache
+from rubberstamp.utils import bulk_insert
+
+
+DISCOVERY_CACHE_KEY = 'rubberstamp.discovery'
+# the longest timeout every cache backend accepts
+DISCOVERY_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+# permissions read by a lazy autodiscover(), until synced
+_pending = None
+_pending_lock = threading.Lock()
+
+
+def get_declared_permissions():
+    """
+    Imports the `permissions` module of each installed app, failing silently
+    when not present, and returns a dict mapping each declared
+    `(app_label, codename)` to a tuple of its description, the list of
+    models it applies to and the list of `(app_label, codename)` of the
+    permissions it implies.
+    
+    A declaration may end with a dict of options; its ``implies`` option
+    lists the permissions implied, each given by its codename (in the same
+    app) or as an `(app_label, codename)` tuple.
+    
+    When a permission is declared more than once, the last description wins
+    and the models and implied permissions are combined.
+    """
+    
+    declared = {}
+    for app in settings.INSTALLED_APPS:
+        mod = import_module(app)
+        if module_has_submodule(mod, 'permissions'):
+            app_label = app.split('.')[-1]
+            perm_module = import_module('%s.permissions' % app)
+            permissions = getattr(perm_module, 'permissions', [])
+            for declaration in permissions:
+                (codename, description, models) = declaration[:3]
+                options = {}
+                if len(declaration) > 3:
+                    options = declaration[3]
+                if not hasattr(models, '__iter__'):
+                    models = [models]
+                implies = [isinstance(p, tuple) and p or (app_label, p)
+                    for p in options.get('implies', ())]
+                key = (app_label, codename)
+                (all_models, all_implies) = declared.get(key, (None, [], []))[1:]
+                all_models.extend([m for m in models if m not in all_models])
+                all_implies.extend([p for p in implies if p not in all_implies])
+                declared[key] = (description, all_models, all_implies)
+    return declared
+
+
+def get_declarations_hash(declared):
+    """Returns a hash of the given declared permissions."""
+    
+    items = []
+    for ((app_label, codename), (description, models, implies)) in declared.items():
+        labels = sorted(['%s.%s' % (m._meta.app_label, m._meta.object_name.lower())
+            for m in models])
+        items.append((app_label, codename, description, labels, sorted(implies)))
+    return md5(repr(sorted(items)).encode('utf-8')).hexdigest()
+
+
+def get_content_types(models):
+    """
+    Returns a dict mapping each of the given models to its ContentType,
+    loading the existing ones with a single query.
+    """
+    
+    keys = dict([(m, (m._meta.app_label, m._meta.object_name.lower()))
+        for m in models])
+    existing = {}
+    app_labels = set([app_label for (app_label, model) in keys.values()])
+    for ct in ContentType.objects.filter(app_label__in=app_labels):
+        existing[(ct.app_label, ct.model)] = ct
+    content_types = {}
+    for (model, key) in keys.items():
+        if key in existing:
+            content_types[model] = existing[key]
+        else:
+            content_types[model] = ContentType.objects.get_for_model(model)
+    return content_types
+
+
+class PermissionDiff(object):
+    """
+    The changes needed to bring the AppPermissions in the database, and the
+    content types they apply to, in line with the declared permissions.
+    """
+    
+    def __init__(self, declared=None):
+        # the declared permissions compared with the database
+        self.declared = declared
+        # (app_label, codename, description) of permissions to create
+        self.added = []
+        # (id, app_label, codename, old description, new description)
+        self.changed = []
+        # (id, app_label, codename) of permissions no longer declared
+        self.stale = []
+        # (app_label, codename, content type) of links to create
+        self.added_links = []
+        # (id, app_label, codename, content type) of links no longer declared
+        self.stale_links = []
+        # (app_label, codename, implied app_label, implied codename) of
+        # implications to create
+        self.added_implications = []
+        # (id, app_label, codename, implied id, implied app_label, implied
+        # codename) of implications no longer declared
+        self.removed_implications = []
+        # (app_label, codename) -> id, of the existing permissions
+        self.perm_ids = {}
+    
+    def is_empty(self, prune=False):
+        """Returns whether there is nothing to change (or to prune)."""
+        
+        if self.added or self.changed or self.added_links:
+            return False
+        if self.added_implications or self.removed_implications:
+            return False
+        return not (prune and (self.stale or self.stale_links))
+
+
+def get_permission_diff(declared):
+    """
+    Compares the given declared permissions (see `get_declared_permissions`)
+    with the database, and returns a `PermissionDiff`. Existing permissions,
+    links and implications are read with one query each.
+    """
+    
+    content_types = get_content_types(
+        set([m for (description, models, implies) in declared.values() for m in models]))
+    diff = PermissionDiff(declared)
+    
+    existing = {}
+    for (perm_id, app_label, codename, description) in AppPermission.objects \
+            .values_list('id', 'app_label', 'codename', 'description'):
+        existing[(app_label, codename)] = description
+        diff.perm_ids[(app_label, codename)] = perm_id
+    
+    for ((app_label, codename), (description, models, implies)) in sorted(declared.items()):
+        if (app_label, codename) not in existing:
+            diff.added.append((app_label, codename, description))
+        elif existing[(app_label, codename)] != description:
+            diff.changed.append((diff.perm_ids[(app_label, codename)], app_label,
+                codename, existing[(app_label, codename)], description))
+    for (app_label, codename) in sorted(existing):
+        if (app_label, codename) not in declared:
+            diff.stale.append((diff.perm_ids[(app_label, codename)], app_label, codename))
+    
+    Link = AppPermission.content_types.through
+    links = set(Link.objects.values_list('apppermission', 'contenttype'))
+    declared_links = set()
+    for ((app_label, codename), (description, models, implies)) in sorted(declared.items()):
+        perm_id = diff.perm_ids.get((app_label, codename))
+        for model in models:
+            ct = content_types[model]
+            declared_links.add((perm_id, ct.id))
+            if (perm_id, ct.id) not in links:
+                diff.added_links.append((app_label, codename, ct))
+    names = dict([(perm_id, key) for (key, perm_id) in diff.perm_ids.items()])
+    stale_links = [(perm_id, ct_id) for (perm_id, ct_id) in sorted(links)
+        if names.get(perm_id) in declared and (perm_id, ct_id) not in declared_links]
+    if stale_links:
+        # content types of removed models have no model class to cache them by
+        stale_types = ContentType.objects.in_bulk(
+            list(set([ct_id for (perm_id, ct_id) in stale_links])))
+        for (perm_id, ct_id) in stale_links:
+            key = names[perm_id]
+            diff.stale_links.append((perm_id, key[0], key[1], stale_types[ct_id]))
+    
+    Implication = AppPermission.implies.through
+    implications = set(Implication.objects \
+        .values_list('from_apppermission', 'to_apppermission'))
+    declared_implications = set()
+    for ((app_label, codename), (description, models, implies)) in sorted(declared.items()):
+        perm_id = diff.perm_ids.get((app_label, codename))
+        for implied in implies:
+            if implied not in declared and implied not in diff.perm_ids:
+                # implies a permission which does not exist
+                continue
+            implied_id = diff.perm_ids.get(implied)
+            declared_implications.add((perm_id, implied_id))
+            if (perm_id, implied_id) not in implications:
+                diff.added_implications.append((app_label, codename) + implied)
+    for (perm_id, implied_id) in sorted(implications):
+        key = names.get(perm_id)
+        if key in declared and (perm_id, implied_id) not in declared_implications:
+            diff.removed_implications.append(
+                (perm_id,) + key + (implied_id,) + names[implied_id])
+    return diff
+
+
+@transaction.commit_on_success
+def apply_permission_diff(diff, prune=False):
+    """
+    Applies the given `PermissionDiff` in a single transaction, inserting
+    new permissions, links and implications in bulk. Implications no longer
+    declared are removed. With `prune`, also deletes stale links, and stale
+    permissions along with their assignments.
+    
+    When another process syncs the same permissions concurrently, inserting
+    rows it created already fails; the diff is then compared again with the
+    database, and what is still missing applied once more.
+    """
+    
+    sid = transaction.savepoint()
+    try:
+        _apply_permission_diff(diff, prune)
+    except IntegrityError:
+        if diff.declared is None:
+            raise
+        transaction.savepoint_rollback(sid)
+        _apply_permission_diff(get_permission_diff(diff.declared), prune)
+    else:
+        transaction.savepoint_commit(sid)
+
+
+def _apply_permission_diff(diff, prune):
+    bulk_insert(AppPermission, [{
+        'app_label': app_label,
+        'codename': codename,
+        'description': description,
+    } for (app_label, codename, description) in diff.added])
+    
+    changed = {}
+    for (perm_id, app_label, codename, old, description) in diff.changed:
+        changed.setdefault(description, []).append(perm_id)
+    for (description, ids) in changed.items():
+        AppPermission.objects.filter(id__in=ids).update(description=description)
+    
+    perm_ids = dict(diff.perm_ids)
+    if diff.added:
+        # fetch the ids of the new permissions
+        for (app_label, codename, perm_id) in AppPermission.objects \
+                .values_list('app_label', 'codename', 'id'):
+            perm_ids[(app_label, codename)] = perm_id
+    
+    Link = AppPermission.content_types.through
+    bulk_insert(Link, [{
+        'apppermission_id': perm_ids[(app_label, codename)],
+        'contenttype_id': ct.id,
+    } for (app_label, codename, ct) in diff.added_links])
+    
+    Implication = AppPermission.implies.through
+    bulk_insert(Implication, [{
+        'from_apppermission_id': perm_ids[(app_label, codename)],
+        'to_apppermission_id': perm_ids[(implied_app_label, implied_codename)],
+    } for (app_label, codename, implied_app_label, implied_codename)
+        in diff.added_implications])
+    removed = {}
+    for (perm_id, app_label, codename, implied_id, implied_app_label, implied_codename) \
+            in diff.removed_implications:
+        removed.setdefault(perm_id, []).append(implied_id)
+    for (perm_id, implied_ids) in removed.items():
+        Implication.objects.filter(from_apppermission=perm_id,
+            to_apppermission__in=implied_ids).delete()
+    
+    if prune:
+        stale_links = {}
+        for (perm_id, app_label, codename, ct) in diff.stale_links:
+            stale_links.setdefault(perm_id, []).append(ct.id)
+        for (perm_id, ct_ids) in stale_links.items():
+            Link.objects.filter(apppermission=perm_id, contenttype__in=ct_ids).delete()
+        if diff.stale:
+            AppPermission.objects.filter(
+                id__in=[perm_id for (perm_id, app_label, codename) in diff.stale]).delete()
+    
+    # bulk inserts and updates send no signals
+    clear_resolution_cache()
+    clear_permission_tree_cache()
+    if diff.added_implications or diff.removed_implications:
+        # loaded permissions include those implied
+        invalidate_permission_cache()
+        invalidate_shared_cache(everyone=True)
+
+
+def sync_permissions(declared):
+    """
+    Creates the given declared permissions (see `get_declared_permissions`)
+    if not created already, updates changed descriptions and implications,
+    and links each permission to the content types of its models.
+    
+    Existing permissions, links and implications are read with one query
+    each, and new ones are inserted in bulk.
+    """
+    
+    apply_permission_diff(get_permission_diff(declared))
+
+
+def sync_pending():
+    """
+    Syncs the permissions read by a lazy `autodiscover()` to the database,
+    unless they were synced already, and returns whether it did.
+    """
+    
+    global _pending
+    _pending_lock.acquire()
+    try:
+        if _pending is None:
+            return False
+        sync_permissions(_pending)
+        _pending = None
+        return True
+    finally:
+        _pending_lock.release()
+
+
+def autodiscover():
+    """
+    Auto-discover INSTALLED_APPS permission.py modules, failing silently when
+    not present, and create all permissions defined by them if not created
+    already.
+    
+    With ``RUBBERSTAMP_AUTODISCOVER = 'lazy'``, the declared permissions are
+    only read, without touching the database, and synced the first time a
+    permission cannot be found (or by the ``rubberstamp_sync`` command). With
+    ``'off'``, nothing is done, and permissions are only synced by the
+    command.
+    
+    With ``RUBBERSTAMP_SKIP_UNCHANGED_DISCOVERY`` on, a hash of the declared
+    permissions is kept in Django's cache after syncing, and later calls skip
+    the database completely while the declarations still match it.
+    """
+    
+    global _pending
+    mode = getattr(settings, 'RUBBERSTAMP_AUTODISCOVER', 'eager')
+    if mode == 'off':
+        return
+    declared = get_declared_permissions()
+    if mode == 'lazy':
+        _pending = declared
+        return
+    
+    skip_unchanged = getattr(settings, 'RUBBERSTAMP_SKIP_UNCHANGED_DISCOVERY', False)
+    if skip_unchanged:
+        declarations_hash = get_declarations_hash(declared)
+        if cache.get(DISCOVERY_CACHE_KEY) == declarations_hash:
+            return
+    
+    sync_permissions(declared)
+    prime_resolution_cache()
+    if skip_unchanged:
+        cache.set(DISCOVERY_CACHE_KEY, declarations_hash, DISCOVERY_CACHE_TIMEOUT)
@@ -10,3 +10,23 @@ class PermissionAssignForm(forms.Form):
         required=False, queryset=User.objects.order_by('username'))
     groups = forms.ModelMultipleChoiceField(
         required=False, queryset=Group.objects.order_by('name'))
+
+
+class PermissionDeltaForm(forms.Form):
+    """
+    A form to add and remove users and groups, by primary key, without
+    listing every user and group as a choice.
+    
+    Only the submitted principals are validated, with one indexed query per
+    field. The selection is expected to be built with the principal lookup
+    view, so the fields render as hidden inputs.
+    """
+    
+    add_users = forms.ModelMultipleChoiceField(required=False,
+        queryset=User.objects.all(), widget=forms.MultipleHiddenInput)
+    remove_users = forms.ModelMultipleChoiceField(required=False,
+        queryset=User.objects.all(), widget=forms.MultipleHiddenInput)
+    add_groups = forms.ModelMultipleChoiceField(required=False,
+        queryset=Group.objects.all(), widget=forms.MultipleHiddenInput)
+    remove_groups = forms.ModelMultipleChoiceField(required=False,
+        queryset=Group.objects.all(), widget=forms.MultipleHiddenInput)
@@ -0,0 +1,145 @@
+"""
+Opt-in timing, query count and cache statistics for permission checks.
+
+Set ``RUBBERSTAMP_INSTRUMENTATION = True`` to enable. Each instrumented call
+then sends the `permission_checked` signal and is passed to the stats
+collectors listed in ``RUBBERSTAMP_STATS_COLLECTORS``, and is added to the
+per-request summary kept by `PermissionStatsMiddleware`.
+"""
+
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connection
+from django.utils.functional import wraps
+from django.utils.importlib import import_module
+
+from rubberstamp.signals import permission_checked
+
+
+_local = threading.local()
+_collectors = {}
+
+
+def is_enabled():
+    return getattr(settings, 'RUBBERSTAMP_INSTRUMENTATION', False)
+
+
+class StatsCollector(object):
+    """
+    Base class for stats collectors. Subclasses are listed by dotted path in
+    ``RUBBERSTAMP_STATS_COLLECTORS``, and are instantiated once per process.
+    """
+    
+    def record(self, name, duration, queries, cache_hits, cache_misses):
+        """
+        Called after each instrumented call, with its name, its duration in
+        seconds, the number of queries it ran (or None if unknown) and its
+        cache hits and misses.
+        """
+        pass
+    
+    def record_request(self, request, summary):
+        """
+        Called by `PermissionStatsMiddleware` at the end of each request,
+        with a dict mapping each call name to a dict of its totals.
+        """
+        pass
+
+
+def get_collectors():
+    paths = getattr(settings, 'RUBBERSTAMP_STATS_COLLECTORS', ())
+    collectors = []
+    for path in paths:
+        if path not in _collectors:
+            (module, name) = path.rsplit('.', 1)
+            _collectors[path] = getattr(import_module(module), name)()
+        collectors.append(_collectors[path])
+    return collectors
+
+
+def _query_count():
+    if settings.DEBUG:
+        return len(connection.queries)
+    return None
+
+
+def record_cache_hit():
+    """Counts a cache hit against the instrumented call in progress."""
+    
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['cache_hits'] += 1
+
+
+def record_cache_miss():
+    """Counts a cache miss against the instrumented call in progress."""
+    
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['cache_misses'] += 1
+
+
+def start_summary():
+    """Starts collecting a summary of instrumented calls in this thread."""
+    
+    _local.summary = {}
+    return _local.summary
+
+
+def end_summary():
+    """Stops collecting, and returns the summary of instrumented calls."""
+    
+    summary = getattr(_local, 'summary', None)
+    _local.summary = None
+    return summary
+
+
+def _record(name, duration, queries, cache_hits, cache_misses):
+    permission_checked.send(sender=name, duration=duration, queries=queries,
+        cache_hits=cache_hits, cache_misses=cache_misses)
+    for collector in get_collectors():
+        collector.record(name, duration, queries, cache_hits, cache_misses)
+    
+    summary = getattr(_local, 'summary', None)
+    if summary is not None:
+        totals = summary.setdefault(name, {'calls': 0, 'duration': 0.0,
+            'queries': 0, 'cache_hits': 0, 'cache_misses': 0})
+        totals['calls'] += 1
+        totals['duration'] += duration
+        totals['cache_hits'] += cache_hits
+        totals['cache_misses'] += cache_misses
+        if queries is None or totals['queries'] is None:
+            totals['queries'] = None
+        else:
+            totals['queries'] += queries
+
+
+def instrumented(name):
+    """
+    Decorator which records the timing, query count and cache hits and
+    misses of each call under the given name, when instrumentation is on.
+    """
+    
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            
+            stack = _local.__dict__.setdefault('stack', [])
+            counters = {'cache_hits': 0, 'cache_misses': 0}
+            stack.append(counters)
+            queries = _query_count()
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = default_timer() - start
+                stack.pop()
+                if queries is not None:
+                    queries = _query_count() - queries
+                _record(name, duration, queries,
+                    counters['cache_hits'], counters['cache_misses'])
+        return wraps(func)(wrapper)
+    return decorator
@@ -0,0 +1,53 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rubberstamp.discovery import get_declared_permissions, get_permission_diff, \
+    apply_permission_diff
+
+
+class Command(NoArgsCommand):
+    help = 'Creates and updates the permissions declared in the permissions modules of installed apps.'
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only show the changes, without applying them.'),
+        make_option('--prune', action='store_true', dest='prune', default=False,
+            help='Also delete permissions (with their assignments) and content '
+                'types which are no longer declared.'),
+    )
+    
+    def handle_noargs(self, **options):
+        dry_run = options.get('dry_run')
+        prune = options.get('prune')
+        verbosity = int(options.get('verbosity', 1))
+        
+        diff = get_permission_diff(get_declared_permissions())
+        if verbosity > 0:
+            for line in self.describe(diff, prune):
+                self.stdout.write(line + '\n')
+            if diff.is_empty(prune):
+                self.stdout.write('Permissions are up to date.\n')
+        if not dry_run and not diff.is_empty(prune):
+            apply_permission_diff(diff, prune=prune)
+    
+    def describe(self, diff, prune):
+        stale = prune and 'Deleting' or 'Stale (use --prune to delete)'
+        for (app_label, codename, description) in diff.added:
+            yield 'Adding permission %s.%s' % (app_label, codename)
+        for (perm_id, app_label, codename, old, description) in diff.changed:
+            yield 'Changing description of %s.%s: "%s" -> "%s"' % (
+                app_label, codename, old, description)
+        for (app_label, codename, ct) in diff.added_links:
+            yield 'Adding %s.%s for %s.%s' % (app_label, codename, ct.app_label, ct.model)
+        for (app_label, codename, implied_app_label, implied_codename) in diff.added_implications:
+            yield 'Adding implication of %s.%s by %s.%s' % (
+                implied_app_label, implied_codename, app_label, codename)
+        for (perm_id, app_label, codename, implied_id, implied_app_label, implied_codename) \
+                in diff.removed_implications:
+            yield 'Removing implication of %s.%s by %s.%s' % (
+                implied_app_label, implied_codename, app_label, codename)
+        for (perm_id, app_label, codename, ct) in diff.stale_links:
+            yield '%s %s.%s for %s.%s' % (stale, app_label, codename, ct.app_label, ct.model)
+        for (perm_id, app_label, codename) in diff.stale:
+            yield '%s permission %s.%s' % (stale, app_label, codename)
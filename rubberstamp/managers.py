@@ -0,0 +1,95 @@
+from django.db import connections, models
+from django.db.models.loading import get_model
+from django.db.models.query import QuerySet
+from django.utils.datastructures import SortedDict
+
+from rubberstamp.utils import filter_permission_targets, get_assigned_for_user, \
+    get_assigned_exists_sql, get_parent_levels
+
+
+class PermissionQuerySet(QuerySet):
+    """
+    A QuerySet which can filter and annotate objects by the permissions a
+    user has for them.
+    
+    Permissions may be given in either the short form, ``'app.codename'``,
+    or the full form; the target type is always this QuerySet's model.
+    """
+    
+    def _resolve(self, permission):
+        AppPermission = get_model('rubberstamp', 'apppermission')
+        return AppPermission.objects.get_permission_and_content_type(permission, self.model)
+    
+    def with_permission(self, user, permission):
+        """
+        Returns only the objects for which the given user has the given
+        permission, for the object itself, for its type or through one of
+        its ancestors.
+        """
+        
+        (perm, ct) = self._resolve(permission)
+        return filter_permission_targets(self, perm, ct, user)
+    
+    def annotate_permissions(self, user, permissions):
+        """
+        Adds a column to each object for each of the given permissions, true
+        if the given user has that permission for the object (or its type),
+        so the objects and their flags are loaded with a single query.
+        
+        Like `with_permission`, permissions inherited from ancestors count
+        (see ``RUBBERSTAMP_PERMISSION_PARENTS``).
+        
+        The permissions are given either as a dict mapping column names to
+        permission strings, or as a list of permission strings, in which case
+        the column for ``'app.codename'`` is named ``can_codename`` (with
+        any dots in the codename replaced by underscores).
+        """
+        
+        if not isinstance(permissions, dict):
+            permissions = SortedDict([
+                ('can_%s' % self._resolve(p)[0].codename.replace('.', '_'), p)
+                for p in permissions])
+        queryset = self._clone()
+        # correlate with the query's own alias of the table; the columns
+        # are left out when the QuerySet is used as a subquery of another
+        alias = queryset.query.get_initial_alias()
+        select = SortedDict()
+        select_params = []
+        for (name, permission) in permissions.items():
+            (perm, ct) = self._resolve(permission)
+            if get_parent_levels(self.model):
+                # inherited permissions take joins through the ancestors, so
+                # the column tests membership of the (uncorrelated) targets
+                (sql, params) = filter_permission_targets(
+                    self.model._base_manager.using(self.db), perm, ct, user) \
+                    .values('pk').query.get_compiler(using=self.db).as_sql()
+                qn = connections[self.db].ops.quote_name
+                sql = '%s.%s IN (%s)' % (qn(alias), qn(self.model._meta.pk.column), sql)
+            else:
+                (sql, params) = get_assigned_exists_sql(
+                    get_assigned_for_user(perm, ct, user), self.model, self.db,
+                    include_type=True, alias=alias)
+            select[name] = sql
+            select_params.extend(params)
+        return queryset.extra(select=select, select_params=select_params)
+
+
+class PermissionManager(models.Manager):
+    """
+    A manager returning `PermissionQuerySet` instances, to be used (or
+    subclassed) as the manager of models whose objects permissions are
+    assigned for::
+        
+        class Document(models.Model):
+            ...
+            objects = PermissionManager()
+    """
+    
+    def get_query_set(self):
+        return PermissionQuerySet(self.model, using=self._db)
+    
+    def with_permission(self, user, permission):
+        return self.get_query_set().with_permission(user, permission)
+    
+    def annotate_permissions(self, user, permissions):
+        return self.get_query_set().annotate_permissions(user, permissions)
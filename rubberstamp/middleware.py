@@ -0,0 +1,37 @@
+import logging
+
+from rubberstamp import instrumentation
+
+
+logger = logging.getLogger('rubberstamp.instrumentation')
+
+
+class PermissionStatsMiddleware(object):
+    """
+    Summarizes the instrumented permission calls made during each request,
+    when ``RUBBERSTAMP_INSTRUMENTATION`` is on.
+    
+    The summary, a dict mapping each call name to its totals, is available
+    as ``request.rubberstamp_stats`` while the request is handled. At the end
+    of the request it is logged and passed to the stats collectors.
+    """
+    
+    def process_request(self, request):
+        if instrumentation.is_enabled():
+            request.rubberstamp_stats = instrumentation.start_summary()
+    
+    def process_response(self, request, response):
+        summary = instrumentation.end_summary()
+        if summary:
+            calls = sum([t['calls'] for t in summary.values()])
+            duration = sum([t['duration'] for t in summary.values()])
+            queries = [t['queries'] for t in summary.values()]
+            if None in queries:
+                queries = 'unknown'
+            else:
+                queries = sum(queries)
+            logger.info('%s: %d permission calls, %.1f ms, %s queries' % (
+                request.path, calls, duration * 1000, queries))
+            for collector in instrumentation.get_collectors():
+                collector.record_request(request, summary)
+        return response
@@ -0,0 +1,110 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# Type-level assignments have a NULL object_id, which unique constraints
+# cannot catch, so they get partial unique indexes where supported.
+PARTIAL_INDEXES = (
+    ('rubberstamp_assignedpermission_type_user_uniq', 'user_id'),
+    ('rubberstamp_assignedpermission_type_group_uniq', 'group_id'),
+)
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Removing duplicate assignments, keeping the first of each
+        db.execute(
+            'DELETE FROM rubberstamp_assignedpermission WHERE id NOT IN ('
+            'SELECT id FROM (SELECT MIN(id) AS id FROM rubberstamp_assignedpermission '
+            'GROUP BY permission_id, content_type_id, object_id, user_id, group_id) AS keep)'
+        )
+
+        # Adding unique constraint on 'AssignedPermission', fields ['permission', 'content_type', 'object_id', 'user']
+        db.create_unique('rubberstamp_assignedpermission', ['permission_id', 'content_type_id', 'object_id', 'user_id'])
+
+        # Adding unique constraint on 'AssignedPermission', fields ['permission', 'content_type', 'object_id', 'group']
+        db.create_unique('rubberstamp_assignedpermission', ['permission_id', 'content_type_id', 'object_id', 'group_id'])
+
+        # Adding partial unique indexes for type-level assignments
+        if db.backend_name in ('postgres', 'sqlite3'):
+            for (name, column) in PARTIAL_INDEXES:
+                db.execute(
+                    'CREATE UNIQUE INDEX %s ON rubberstamp_assignedpermission '
+                    '(permission_id, content_type_id, %s) WHERE object_id IS NULL' % (name, column)
+                )
+
+
+    def backwards(self, orm):
+        
+        # Removing partial unique indexes for type-level assignments
+        if db.backend_name in ('postgres', 'sqlite3'):
+            for (name, column) in PARTIAL_INDEXES:
+                db.execute('DROP INDEX %s' % name)
+
+        # Removing unique constraint on 'AssignedPermission', fields ['permission', 'content_type', 'object_id', 'group']
+        db.delete_unique('rubberstamp_assignedpermission', ['permission_id', 'content_type_id', 'object_id', 'group_id'])
+
+        # Removing unique constraint on 'AssignedPermission', fields ['permission', 'content_type', 'object_id', 'user']
+        db.delete_unique('rubberstamp_assignedpermission', ['permission_id', 'content_type_id', 'object_id', 'user_id'])
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'rubberstamp.apppermission': {
+            'Meta': {'unique_together': "(('app_label', 'codename'),)", 'object_name': 'AppPermission'},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_types': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['contenttypes.ContentType']", 'symmetrical': 'False'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'rubberstamp.assignedpermission': {
+            'Meta': {'unique_together': "(('permission', 'content_type', 'object_id', 'user'), ('permission', 'content_type', 'object_id', 'group'))", 'object_name': 'AssignedPermission'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'group': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.Group']", 'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'permission': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['rubberstamp.AppPermission']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'null': 'True'})
+        }
+    }
+
+    complete_apps = ['rubberstamp']
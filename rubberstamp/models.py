@@ -1,9 +1,15 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, signals
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
-from rubberstamp.utils import get_perm_q_for_user
+from rubberstamp.utils import chunked, bulk_insert, bulk_delete, \
+    get_object_field, get_object_value
 from rubberstamp.exceptions import PermissionLookupError
+from rubberstamp.cache import invalidate_permission_cache, invalidate_group_cache, \
+    get_resolved_permission, set_resolved_permission, clear_resolution_cache, \
+    clear_permission_tree_cache, invalidate_shared_cache, invalidate_shared_principal, \
+    invalidate_shared_membership, invalidate_shared_permissions
 
 
 class AppPermissionManager(models.Manager):
@@ -19,8 +25,20 @@ class AppPermissionManager(models.Manager):
         
         If the correct AppPermission and ContentType cannot be determined for
         the passed parameters, a `PermissionLookupError` is raised.
+        
+        Successful lookups are cached for the life of the process, and the
+        cache is cleared whenever an AppPermission or its content types
+        change.
         """
         
+        obj_ct = None
+        if obj:
+            obj_ct = ContentType.objects.get_for_model(obj)
+        
+        resolved = get_resolved_permission(permission, obj_ct and obj_ct.id)
+        if resolved:
+            return resolved
+        
         perm_ct = None
         bits = permission.split('.')
         app_label = bits.pop(0)
@@ -36,10 +54,6 @@ class AppPermissionManager(models.Manager):
         else:
             codename = '.'.join(bits)
         
-        obj_ct = None
-        if obj:
-            obj_ct = ContentType.objects.get_for_model(obj)
-        
         content_type = perm_ct or obj_ct
         if not (content_type):
             raise PermissionLookupError('ContentType must be given in permission, or object must be passed.')
@@ -47,7 +61,7 @@ class AppPermissionManager(models.Manager):
             raise PermissionLookupError('ContentType in permission and passed object mismatched.')
         
         try:
-            return (
+            resolved = (
                 self.get(
                     app_label=app_label,
                     content_types=content_type,
@@ -56,7 +70,13 @@ class AppPermissionManager(models.Manager):
                 content_type
             )
         except self.model.DoesNotExist:
+            from rubberstamp.discovery import sync_pending
+            if sync_pending():
+                # declared by a lazy autodiscover(), but not yet synced
+                return self.get_permission_and_content_type(permission, obj)
             raise PermissionLookupError('AppPermission not found.')
+        set_resolved_permission(permission, obj_ct and obj_ct.id, resolved)
+        return resolved
     
     def assign(self, permission, user_or_group, obj=None):
         """
@@ -64,6 +84,9 @@ class AppPermissionManager(models.Manager):
         the AssignedPermission instance.
         
         If an object is given, assigns the permission for that object.
+        
+        Cached user permissions are invalidated through the `post_save`
+        signal of `AssignedPermission`.
         """
         
         (perm, ct) = self.get_permission_and_content_type(permission, obj)
@@ -71,12 +94,14 @@ class AppPermissionManager(models.Manager):
         assigned_dict = {
             'permission': perm,
             'content_type': ct,
-            'object_id': None
+            'object_id': None,
+            'object_key': None
         }
         
         if obj:
-            assigned_dict['object_id'] = obj.id
-
+            model = type(obj)
+            assigned_dict[get_object_field(model)] = get_object_value(model, obj.pk)
+        
         if isinstance(user_or_group, User):
             assigned_dict['user'] = user_or_group
         elif isinstance(user_or_group, Group):
@@ -92,6 +117,9 @@ class AppPermissionManager(models.Manager):
         the deleted AssignedPermission instance or None if not found.
         
         If an object is given, removes the permission for that object.
+        
+        Cached user permissions are invalidated through the `post_delete`
+        signal of `AssignedPermission`.
         """
         
         (perm, ct) = self.get_permission_and_content_type(permission, obj)
@@ -99,12 +127,14 @@ class AppPermissionManager(models.Manager):
         assigned_dict = {
             'permission': perm,
             'content_type': ct,
-            'object_id': None
+            'object_id': None,
+            'object_key': None
         }
         
         if obj:
-            assigned_dict['object_id'] = obj.id
-
+            model = type(obj)
+            assigned_dict[get_object_field(model)] = get_object_value(model, obj.pk)
+        
         if isinstance(user_or_group, User):
             assigned_dict['user'] = user_or_group
         elif isinstance(user_or_group, Group):
@@ -120,9 +150,200 @@ class AppPermissionManager(models.Manager):
             assigned.delete()
             return assigned
     
+    def assign_many(self, permission, principals, objects=None):
+        """
+        Assigns the given permission to each of the given users and groups,
+        and returns the number of AssignedPermission rows created.
+        
+        If objects are given, assigns the permission for each of them;
+        otherwise assigns it for the type. Assignments which already exist
+        are left alone.
+        """
+        
+        (perm, ct, object_ids) = self._resolve_many(permission, objects)
+        (users, groups) = self._split_principals(principals,
+            'Permissions must be assigned to a User or Group instance.')
+        created = self._bulk_assign(perm, ct, users, groups, object_ids)
+        if created:
+            self._invalidate_shared(users, groups)
+        return created
+    
+    def remove_many(self, permission, principals, objects=None):
+        """
+        Removes the given permission from each of the given users and groups,
+        and returns the number of AssignedPermission rows deleted.
+        
+        If objects are given, removes the permission for each of them;
+        otherwise removes it for the type.
+        """
+        
+        (perm, ct, object_ids) = self._resolve_many(permission, objects)
+        (users, groups) = self._split_principals(principals,
+            'Permissions can only be removed from a User or Group instance.')
+        removed = self._bulk_remove(perm, ct, users, groups, object_ids)
+        if removed:
+            self._invalidate_shared(users, groups)
+        return removed
+    
+    def _resolve_many(self, permission, objects):
+        """
+        Resolves the permission once for a list of objects of one type, and
+        returns the AppPermission, the ContentType and the object ids (a list
+        of just None for the type itself).
+        """
+        
+        if objects is None:
+            (perm, ct) = self.get_permission_and_content_type(permission)
+            return (perm, ct, [None])
+        
+        objects = list(objects)
+        if not objects:
+            # nothing to do, and nothing to resolve the type from
+            return (None, None, [])
+        (perm, ct) = self.get_permission_and_content_type(permission, objects[0])
+        for obj in objects:
+            if ContentType.objects.get_for_model(obj) != ct:
+                raise PermissionLookupError('Objects must all be of the same type.')
+        return (perm, ct, [obj.pk for obj in objects])
+    
+    def _split_principals(self, principals, message):
+        users = {}
+        groups = {}
+        for principal in principals:
+            if isinstance(principal, User):
+                users[principal.pk] = principal
+            elif isinstance(principal, Group):
+                groups[principal.pk] = principal
+            else:
+                raise TypeError(message)
+        return (list(users.values()), list(groups.values()))
+    
+    def _assigned_for(self, perm, ct, users, groups, object_ids):
+        """
+        Returns a QuerySet of the AssignedPermissions of the given permission
+        and type for the given users, groups and object ids.
+        """
+        
+        principal_q = Q(pk=None)
+        if users:
+            principal_q = principal_q | Q(user__in=users)
+        if groups:
+            principal_q = principal_q | Q(group__in=groups)
+        field = get_object_field(ct.model_class())
+        if object_ids == [None]:
+            object_q = Q(**{'%s__isnull' % field: True})
+        else:
+            object_q = Q(**{'%s__in' % field: object_ids})
+        return AssignedPermission.objects.filter(
+            principal_q & object_q, permission=perm, content_type=ct)
+    
+    def _batches(self, users, groups, object_ids):
+        """
+        Yields `(users, groups, object_ids)` batches covering every
+        combination of the given principals and object ids, small enough to
+        keep `IN` lists within the limits of every database backend.
+        """
+        
+        principals = [(u, None) for u in users] + [(None, g) for g in groups]
+        for ids in chunked(object_ids, 250):
+            for batch in chunked(principals, 250):
+                yield (
+                    [u for (u, g) in batch if u],
+                    [g for (u, g) in batch if g],
+                    ids
+                )
+    
+    def update_assignments(self, permission, content_type, add=(), remove=(), obj=None):
+        """
+        Assigns the given `AppPermission` for the given `ContentType` to the
+        users and groups in `add`, and removes it from those in `remove`, in a
+        single transaction. Returns the numbers of rows created and deleted.
+        
+        Unlike the other methods, this takes an already resolved permission
+        and type, for callers (like the ``type_perms`` view) which have them
+        at hand. If an object is given, the changes apply to it instead of
+        the type.
+        """
+        
+        object_ids = [obj.pk if obj is not None else None]
+        (add_users, add_groups) = self._split_principals(add,
+            'Permissions must be assigned to a User or Group instance.')
+        (remove_users, remove_groups) = self._split_principals(remove,
+            'Permissions can only be removed from a User or Group instance.')
+        (created, removed) = self._bulk_update(permission, content_type, object_ids,
+            add_users, add_groups, remove_users, remove_groups)
+        if created or removed:
+            self._invalidate_shared(add_users + remove_users, add_groups + remove_groups)
+        return (created, removed)
+    
+    def _invalidate_shared(self, users, groups):
+        # bulk inserts send no signals; invalidating after the commit also
+        # drops any entry cached from data read before it
+        invalidate_shared_cache(
+            user_ids=[u.pk for u in users], group_ids=[g.pk for g in groups])
+    
+    @transaction.commit_on_success
+    def _bulk_assign(self, perm, ct, users, groups, object_ids):
+        return self._insert_assigned(perm, ct, users, groups, object_ids)
+    
+    @transaction.commit_on_success
+    def _bulk_remove(self, perm, ct, users, groups, object_ids):
+        return self._delete_assigned(perm, ct, users, groups, object_ids)
+    
+    @transaction.commit_on_success
+    def _bulk_update(self, perm, ct, object_ids, add_users, add_groups,
+            remove_users, remove_groups):
+        return (
+            self._insert_assigned(perm, ct, add_users, add_groups, object_ids),
+            self._delete_assigned(perm, ct, remove_users, remove_groups, object_ids),
+        )
+    
+    def _insert_assigned(self, perm, ct, users, groups, object_ids):
+        if not object_ids:
+            return 0
+        model = ct.model_class()
+        field = get_object_field(model)
+        object_ids = [get_object_value(model, obj_id) for obj_id in object_ids]
+        created = 0
+        for (users, groups, ids) in self._batches(users, groups, object_ids):
+            existing = set(self._assigned_for(perm, ct, users, groups, ids) \
+                .values_list('user', 'group', field))
+            rows = []
+            for obj_id in ids:
+                rows.extend([(u.pk, None, obj_id) for u in users])
+                rows.extend([(None, g.pk, obj_id) for g in groups])
+            rows = [row for row in rows if row not in existing]
+            bulk_insert(AssignedPermission, [{
+                'permission_id': perm.pk,
+                'content_type_id': ct.pk,
+                'user_id': user_id,
+                'group_id': group_id,
+                'object_id': None,
+                'object_key': None,
+                field: obj_id,
+            } for (user_id, group_id, obj_id) in rows])
+            created += len(rows)
+        if created:
+            # bulk inserts send no post_save signals
+            invalidate_permission_cache()
+        return created
+    
+    def _delete_assigned(self, perm, ct, users, groups, object_ids):
+        if not object_ids:
+            return 0
+        model = ct.model_class()
+        object_ids = [get_object_value(model, obj_id) for obj_id in object_ids]
+        removed = 0
+        for (users, groups, ids) in self._batches(users, groups, object_ids):
+            removed += bulk_delete(self._assigned_for(perm, ct, users, groups, ids))
+        if removed:
+            # bulk deletes send no post_delete signals
+            invalidate_permission_cache()
+        return removed
+    
     def get_by_natural_key(self, app_label, codename):
         return self.get(app_label=app_label, codename=codename)
-        
+
 
 
 class AppPermission(models.Model):
@@ -135,6 +356,10 @@ class AppPermission(models.Model):
     codename = models.CharField(max_length=100)
     description = models.CharField(max_length=100)
     content_types = models.ManyToManyField(ContentType)
+    # the permissions this one implies directly; those they imply in turn are
+    # implied too, for the content types each of them applies to
+    implies = models.ManyToManyField('self', symmetrical=False,
+        related_name='implied_by', blank=True)
     
     objects = AppPermissionManager()
     
@@ -156,5 +381,45 @@ class AssignedPermission(models.Model):
     group = models.ForeignKey(Group, null=True)
     
     content_type = models.ForeignKey(ContentType)
+    # the primary key of the object, if assigned for one: in object_id if an
+    # integer, otherwise as text in object_key (see utils.get_object_field)
     object_id = models.PositiveIntegerField(null=True)
+    object_key = models.CharField(max_length=255, null=True)
     content_object = GenericForeignKey()
+    
+    class Meta:
+        # These double as the composite indexes for permission checks. Since
+        # NULLs never collide, type-level assignments (object_id and
+        # object_key NULL) are kept unique by the partial indexes in sql/ and
+        # the migrations.
+        unique_together = (
+            ('permission', 'content_type', 'object_id', 'user'),
+            ('permission', 'content_type', 'object_id', 'group'),
+            ('permission', 'content_type', 'object_key', 'user'),
+            ('permission', 'content_type', 'object_key', 'group'),
+        )
+
+
+signals.post_save.connect(invalidate_permission_cache, sender=AssignedPermission)
+signals.post_delete.connect(invalidate_permission_cache, sender=AssignedPermission)
+signals.m2m_changed.connect(invalidate_permission_cache, sender=User.groups.through)
+signals.m2m_changed.connect(invalidate_group_cache, sender=User.groups.through)
+signals.post_save.connect(clear_resolution_cache, sender=AppPermission)
+signals.post_delete.connect(clear_resolution_cache, sender=AppPermission)
+signals.m2m_changed.connect(clear_resolution_cache, sender=AppPermission.content_types.through)
+signals.m2m_changed.connect(invalidate_permission_cache, sender=AppPermission.content_types.through)
+signals.post_delete.connect(clear_resolution_cache, sender=ContentType)
+signals.post_save.connect(clear_permission_tree_cache, sender=AppPermission)
+signals.post_delete.connect(clear_permission_tree_cache, sender=AppPermission)
+signals.m2m_changed.connect(clear_permission_tree_cache, sender=AppPermission.content_types.through)
+signals.post_delete.connect(clear_permission_tree_cache, sender=ContentType)
+signals.post_save.connect(invalidate_shared_principal, sender=AssignedPermission)
+signals.post_delete.connect(invalidate_shared_principal, sender=AssignedPermission)
+signals.m2m_changed.connect(invalidate_shared_membership, sender=User.groups.through)
+signals.post_save.connect(invalidate_shared_permissions, sender=AppPermission)
+signals.post_delete.connect(invalidate_shared_permissions, sender=AppPermission)
+signals.post_delete.connect(invalidate_shared_permissions, sender=ContentType)
+signals.m2m_changed.connect(clear_resolution_cache, sender=AppPermission.implies.through)
+signals.m2m_changed.connect(invalidate_permission_cache, sender=AppPermission.implies.through)
+signals.m2m_changed.connect(invalidate_shared_permissions, sender=AppPermission.implies.through)
+signals.post_delete.connect(invalidate_permission_cache, sender=AppPermission)
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# Sent after each instrumented permission call, when instrumentation is
+# enabled. The sender is the name of the call, e.g. 'has_perm'; `queries` is
+# None unless Django is recording queries (i.e. DEBUG is on).
+permission_checked = Signal(providing_args=[
+    'duration', 'queries', 'cache_hits', 'cache_misses'])
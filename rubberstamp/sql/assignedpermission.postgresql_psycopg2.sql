@@ -0,0 +1,8 @@
+-- Type-level assignments have a NULL object_id and object_key, which the
+-- unique_together constraints cannot catch, so they get partial unique indexes instead.
+CREATE UNIQUE INDEX "rubberstamp_assignedpermission_type_user_uniq"
+    ON "rubberstamp_assignedpermission" ("permission_id", "content_type_id", "user_id")
+    WHERE "object_id" IS NULL AND "object_key" IS NULL;
+CREATE UNIQUE INDEX "rubberstamp_assignedpermission_type_group_uniq"
+    ON "rubberstamp_assignedpermission" ("permission_id", "content_type_id", "group_id")
+    WHERE "object_id" IS NULL AND "object_key" IS NULL;
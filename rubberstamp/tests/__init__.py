@@ -3,3 +3,5 @@ from rubberstamp.tests.models import *
 from rubberstamp.tests.backends import *
 from rubberstamp.tests.views import *
 from rubberstamp.tests.utils import *
+from rubberstamp.tests.instrumentation import *
+from rubberstamp.tests.managers import *
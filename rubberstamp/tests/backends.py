@@ -1,8 +1,20 @@
-from django.contrib.auth.models import User, AnonymousUser
+from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import signals
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User, Group, AnonymousUser
+from django.contrib.contenttypes.models import ContentType
 from rubberstamp.tests.base import RubberStampTestCase
 
 from rubberstamp.models import AppPermission, AssignedPermission
-from rubberstamp.tests.testapp.models import TestModel
+from rubberstamp.backends import AppPermissionBackend
+from rubberstamp.cache import get_shared_cache, clear_group_rows_cache, VERSION_KEY, \
+    ENTRY_KEY, PermissionIndex, get_user_permissions
+from rubberstamp import cache
+from rubberstamp.tests.testapp.models import TestModel, KeyedTestModel, BigKeyedTestModel, \
+    SignedKeyedTestModel, OtherTestModel
+from rubberstamp.utils import get_permission_targets, filter_allowed, has_perm_for_objects
 
 
 class BackendTestNoneAssigned(RubberStampTestCase):
@@ -51,10 +63,11 @@ class BackendTestTypeAssigned(RubberStampTestCase):
         self.assertTrue(self.user.has_perm('testapp.use.testapp.testmodel'))
     
     def test_with_object(self):
-        self.assertFalse(self.user.has_perm('testapp.use', obj=self.object))
+        # a permission assigned for the type applies to its objects
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.object))
     
     def test_with_both(self):
-        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel', obj=self.object))
+        self.assertTrue(self.user.has_perm('testapp.use.testapp.testmodel', obj=self.object))
     
     def test_with_both_mismatched(self):
         self.assertFalse(self.user.has_perm('testapp.use.auth.user', obj=self.object))
@@ -64,8 +77,11 @@ class BackendTestTypeAssigned(RubberStampTestCase):
         self.assertTrue(self.user.has_module_perms('testapp'))
     
     def test_get_all(self):
-        self.assertEqual(len(self.user.get_all_permissions()), 1)
-        self.assertEqual(len(self.user.get_all_permissions(obj=self.object)), 0)
+        self.assertEqual(self.user.get_all_permissions(),
+            set(['testapp.use.testapp.testmodel']))
+        # a permission assigned for the type applies to its objects
+        self.assertEqual(self.user.get_all_permissions(obj=self.object),
+            set(['testapp.use.testapp.testmodel']))
         self.assertEqual(len(self.user.get_all_permissions(obj=self.user)), 0)
 
 
@@ -97,10 +113,109 @@ class BackendTestObjectAssigned(RubberStampTestCase):
     
     def test_get_all(self):
         self.assertEqual(len(self.user.get_all_permissions()), 1)
-        self.assertEqual(len(self.user.get_all_permissions(obj=self.object)), 1)
+        self.assertEqual(self.user.get_all_permissions(obj=self.object),
+            set(['testapp.use.testapp.testmodel']))
         self.assertEqual(len(self.user.get_all_permissions(obj=self.user)), 0)
 
 
+class BackendTestKeyedObject(RubberStampTestCase):
+    """Tests for objects with primary keys which are not integers."""
+    fixtures = ['users.json', 'permissions.json']
+    
+    def setUp(self):
+        self._original_backend = getattr(settings, 'RUBBERSTAMP_CACHE_BACKEND', None)
+        AppPermission.objects.get(codename='use').content_types.add(
+            ContentType.objects.get_for_model(KeyedTestModel))
+        self.user = User.objects.get(pk=2)
+        self.object = KeyedTestModel.objects.create(key='a')
+        self.other = KeyedTestModel.objects.create(key='b')
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.object)
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_CACHE_BACKEND = self._original_backend
+    
+    def test_assigned(self):
+        assigned = AssignedPermission.objects.get(user=self.user)
+        self.assertEqual((assigned.object_id, assigned.object_key), (None, 'a'))
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.object))
+        self.assertFalse(self.user.has_perm('testapp.use', obj=self.other))
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.keyedtestmodel'))
+        self.assertEqual(self.user.get_all_permissions(obj=self.object),
+            set(['testapp.use.testapp.keyedtestmodel']))
+        self.assertEqual(len(self.user.get_all_permissions(obj=self.other)), 0)
+    
+    def test_type_assigned(self):
+        AppPermission.objects.assign('testapp.use.testapp.keyedtestmodel', self.user)
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.other))
+    
+    def test_remove(self):
+        self.assertEqual(AppPermission.objects.remove(
+            'testapp.use', self.user, obj=self.object).object_key, 'a')
+        self.assertFalse(self.user.has_perm('testapp.use', obj=self.object))
+    
+    def test_shared_cache(self):
+        settings.RUBBERSTAMP_CACHE_BACKEND = 'locmem://'
+        get_shared_cache().clear()
+        try:
+            self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use', obj=self.object))
+            self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use', obj=self.object))
+        finally:
+            get_shared_cache().clear()
+
+
+class BackendTestIntegerKeyedObject(RubberStampTestCase):
+    """Tests for objects with integer keys which don't fit ``object_id``."""
+    fixtures = ['users.json', 'permissions.json']
+    
+    def setUp(self):
+        self._original_backend = getattr(settings, 'RUBBERSTAMP_CACHE_BACKEND', None)
+        self._original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        self.user = User.objects.get(pk=2)
+        perm = AppPermission.objects.get(codename='use')
+        self.objects = []
+        for (model, key) in ((BigKeyedTestModel, 2 ** 40), (SignedKeyedTestModel, -5)):
+            perm.content_types.add(ContentType.objects.get_for_model(model))
+            obj = model.objects.create(key=key)
+            model.objects.create(key=1)
+            AppPermission.objects.assign('testapp.use', self.user, obj=obj)
+            self.objects.append(obj)
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_CACHE_BACKEND = self._original_backend
+        settings.RUBBERSTAMP_TARGETS_STRATEGY = self._original_strategy
+    
+    def test_assigned(self):
+        for obj in self.objects:
+            assigned = AssignedPermission.objects.get(user=self.user, object_key=str(obj.pk))
+            self.assertEqual(assigned.object_id, None)
+            self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use', obj=obj))
+            self.assertFalse(User.objects.get(pk=2).has_perm('testapp.use',
+                obj=type(obj).objects.get(key=1)))
+            self.assertEqual(filter_allowed('testapp.use', self.user, type(obj).objects.all()),
+                [obj])
+    
+    def test_targets(self):
+        for strategy in ('in', 'exists'):
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+            for obj in self.objects:
+                model = type(obj)
+                permission = 'testapp.use.testapp.%s' % model._meta.object_name.lower()
+                self.assertEqual(list(get_permission_targets(permission, self.user)), [obj])
+                self.assertEqual([o.can_use for o in model.objects.order_by('key')
+                    .annotate_permissions(self.user, ['testapp.use'])
+                    if o.pk == obj.pk], [1])
+    
+    def test_shared_cache(self):
+        settings.RUBBERSTAMP_CACHE_BACKEND = 'locmem://'
+        get_shared_cache().clear()
+        try:
+            for obj in self.objects:
+                self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use', obj=obj))
+                self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use', obj=obj))
+        finally:
+            get_shared_cache().clear()
+
+
 class BackendTestBothAssigned(RubberStampTestCase):
     fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json', 'assigned_object.json']
     
@@ -151,7 +266,7 @@ class BackendTestTypeByGroup(RubberStampTestCase):
     
     def test_get_all(self):
         self.assertEqual(len(self.grouper.get_all_permissions()), 1)
-        self.assertEqual(len(self.grouper.get_all_permissions(obj=self.object)), 0)
+        self.assertEqual(len(self.grouper.get_all_permissions(obj=self.object)), 1)
         self.assertEqual(len(self.grouper.get_all_permissions(obj=self.grouper)), 0)
 
 
@@ -210,12 +325,429 @@ class BackendTestAnonymousUser(RubberStampTestCase):
         self.assertEqual(len(self.anon.get_all_permissions(obj=self.user)), 0)
 
 
+class BackendTestCache(RubberStampTestCase):
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json']
+    
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        self.grouper = User.objects.get(pk=3)
+        self.object = TestModel.objects.get(pk=1)
+    
+    def test_loaded_once(self):
+        backend = AppPermissionBackend()
+        # load the closure of implied permissions ahead of counting queries
+        cache.get_implications()
+        self.assertNumQueries(1, backend.has_module_perms, self.user, 'testapp')
+        self.assertNumQueries(0, backend.has_module_perms, self.user, 'testapp')
+        self.assertNumQueries(0, backend.get_all_permissions, self.user)
+    
+    def test_assign_invalidates(self):
+        self.assertFalse(self.user.has_perm('testapp.have', obj=self.object))
+        AppPermission.objects.assign('testapp.have', self.user, obj=self.object)
+        self.assertTrue(self.user.has_perm('testapp.have', obj=self.object))
+    
+    def test_remove_invalidates(self):
+        self.assertTrue(self.user.has_perm('testapp.use.testapp.testmodel'))
+        AppPermission.objects.remove('testapp.use.testapp.testmodel', self.user)
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_check_perms(self):
+        """Many checks are answered from one load of the permissions."""
+        backend = AppPermissionBackend()
+        checks = [
+            ('testapp.use.testapp.testmodel', None),
+            ('testapp.have.testapp.testmodel', None),
+            ('testapp.use', self.object),
+            ('testapp.nonexistent', self.object),
+        ]
+        # resolve the permissions ahead of counting queries (failed lookups
+        # are not cached)
+        backend.check_perms(User.objects.get(pk=2), checks)
+        self.assertNumQueries(1, backend.check_perms, self.user, checks[:3])
+        self.assertEqual(backend.check_perms(self.user, checks), [True, False, True, False])
+        self.assertEqual(backend.check_perms(self.grouper, checks), [False, True, False, False])
+        self.assertEqual(backend.check_perms(self.user, []), [])
+    
+    def test_group_change_invalidates(self):
+        self.assertTrue(self.grouper.has_perm('testapp.have.testapp.testmodel'))
+        self.grouper.groups.clear()
+        self.assertFalse(self.grouper.has_perm('testapp.have.testapp.testmodel'))
+
+
+class BackendTestInheritance(RubberStampTestCase):
+    """Tests for implied permissions and permissions inherited from parents."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json']
+    
+    def setUp(self):
+        self._original_parents = getattr(settings, 'RUBBERSTAMP_PERMISSION_PARENTS', {})
+        settings.RUBBERSTAMP_PERMISSION_PARENTS = {'testapp.testmodel': 'parent'}
+        use = AppPermission.objects.get(codename='use')
+        have = AppPermission.objects.get(codename='have')
+        have.implies.add(use)
+        AppPermission.objects.get(codename='long.permission.name').implies.add(have)
+        self.user = User.objects.get(pk=2)
+        self.grouper = User.objects.get(pk=3)
+        self.folder = TestModel.objects.get(pk=1)
+        self.child = TestModel.objects.create(parent=self.folder)
+        self.grandchild = TestModel.objects.create(parent=self.child)
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_PERMISSION_PARENTS = self._original_parents
+        # the implications are rolled back without any signal
+        cache.clear_resolution_cache()
+    
+    def test_implied(self):
+        AppPermission.objects.assign('testapp.long.permission.name.testapp.testmodel',
+            Group.objects.get(pk=1))
+        self.assertTrue(self.grouper.has_perm('testapp.use.testapp.testmodel'))
+        self.assertTrue(self.grouper.has_perm('testapp.have', obj=self.folder))
+        self.assertTrue(self.grouper.has_module_perms('testapp'))
+        self.assertEqual(self.grouper.get_all_permissions(), set([
+            'testapp.use.testapp.testmodel',
+            'testapp.have.testapp.testmodel',
+            'testapp.long.permission.name.testapp.testmodel',
+        ]))
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_implied_loaded_once(self):
+        """The closure is loaded once, and the user's permissions with one query."""
+        AppPermission.objects.assign('testapp.have.testapp.testmodel', self.user)
+        AppPermission.objects.get_permission_and_content_type('testapp.use.testapp.testmodel')
+        backend = AppPermissionBackend()
+        self.assertNumQueries(3, backend.has_module_perms, self.user, 'testapp')
+        self.assertNumQueries(1, backend.has_module_perms, User.objects.get(pk=2), 'testapp')
+        self.assertNumQueries(0, backend.has_perm, self.user, 'testapp.use.testapp.testmodel')
+    
+    def test_implication_change(self):
+        AppPermission.objects.assign('testapp.have', self.user, obj=self.folder)
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.folder))
+        AppPermission.objects.get(codename='have').implies.clear()
+        self.assertFalse(self.user.has_perm('testapp.use', obj=self.folder))
+    
+    def test_implied_content_types(self):
+        """Implied permissions only apply to their own content types."""
+        other = AppPermission.objects.create(app_label='testapp', codename='other')
+        other.content_types.add(ContentType.objects.get_for_model(OtherTestModel))
+        AppPermission.objects.get(codename='have').implies.add(other)
+        AppPermission.objects.assign('testapp.have.testapp.testmodel', self.user)
+        self.assertEqual(self.user.get_all_permissions(), set([
+            'testapp.use.testapp.testmodel',
+            'testapp.have.testapp.testmodel',
+        ]))
+        self.assertFalse(self.user.has_perm('testapp.other.testapp.othertestmodel'))
+    
+    def test_implied_one_way(self):
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.folder)
+        self.assertFalse(self.user.has_perm('testapp.have', obj=self.folder))
+    
+    def test_implied_targets(self):
+        AppPermission.objects.assign('testapp.have', self.user, obj=self.child)
+        # the grandchild inherits it from the child
+        self.assertEqual(list(get_permission_targets('testapp.use.testapp.testmodel', self.user)
+            .order_by('pk')), [self.child, self.grandchild])
+        self.assertEqual(filter_allowed('testapp.use', self.user, TestModel.objects.order_by('pk')),
+            [self.child, self.grandchild])
+    
+    def test_parent(self):
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.folder)
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.child))
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.grandchild))
+        self.assertFalse(self.user.has_perm('testapp.have', obj=self.grandchild))
+        self.assertFalse(self.user.has_perm('testapp.use', obj=TestModel.objects.create()))
+    
+    def test_parent_batch(self):
+        """Objects and QuerySets are checked for inherited permissions as has_perm does."""
+        other = TestModel.objects.create()
+        AppPermission.objects.assign('testapp.have', self.user, obj=self.folder)
+        objects = [self.folder, self.child, self.grandchild, other]
+        expected = [self.folder, self.child, self.grandchild]
+        self.assertEqual([o for o in objects if self.user.has_perm('testapp.use', obj=o)],
+            expected)
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        try:
+            for strategy in ('in', 'exists'):
+                settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+                for user in (User.objects.get(pk=2), self.user):
+                    # with and without the backend's cache loaded
+                    self.assertEqual(filter_allowed('testapp.use', user, objects), expected)
+                    self.assertEqual(has_perm_for_objects('testapp.use', user, objects),
+                        {self.folder.pk: True, self.child.pk: True,
+                         self.grandchild.pk: True, other.pk: False})
+                    self.assertEqual(list(get_permission_targets(
+                        'testapp.use.testapp.testmodel', user).order_by('pk')), expected)
+                    self.assertEqual(list(TestModel.objects.filter(parent__isnull=False)
+                        .with_permission(user, 'testapp.use').order_by('pk')), expected[1:])
+                    self.assertEqual([bool(o.can_use) for o in TestModel.objects.order_by('pk')
+                        .annotate_permissions(user, ['testapp.use'])], [True, True, True, False])
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+        
+        AppPermission.objects.assign('testapp.use', self.user, obj=other)
+        self.assertEqual(filter_allowed('testapp.use', User.objects.get(pk=2), objects), objects)
+    
+    def test_parent_queries(self):
+        """Parents are only loaded when something could be inherited from them."""
+        grandchild = TestModel.objects.get(pk=self.grandchild.pk)
+        backend = AppPermissionBackend()
+        AppPermission.objects.get_permission_and_content_type('testapp.use', grandchild)
+        backend.has_module_perms(self.user, 'testapp')
+        self.assertNumQueries(0, backend.has_perm, self.user, 'testapp.use', grandchild)
+        
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.folder)
+        backend.has_module_perms(self.user, 'testapp')
+        # the parent's key is read from the object, the others with one query
+        self.assertNumQueries(1, backend.has_perm, self.user, 'testapp.use', grandchild)
+        self.assertNumQueries(0, backend.has_perm, self.user, 'testapp.use', grandchild)
+    
+    def test_parent_chain_queries(self):
+        """The keys of every ancestor are read with a single query."""
+        great = TestModel.objects.create(parent=self.grandchild)
+        backend = AppPermissionBackend()
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.folder)
+        AppPermission.objects.get_permission_and_content_type('testapp.use', great)
+        backend.has_module_perms(self.user, 'testapp')
+        great = TestModel.objects.get(pk=great.pk)
+        self.assertNumQueries(1, backend.has_perm, self.user, 'testapp.use', great)
+        self.assertTrue(backend.has_perm(self.user, 'testapp.use', great))
+        self.assertFalse(backend.has_perm(self.user, 'testapp.have', great))
+        
+        settings.RUBBERSTAMP_PERMISSION_PARENTS_DEPTH = 2
+        try:
+            self.assertFalse(backend.has_perm(self.user, 'testapp.use',
+                TestModel.objects.get(pk=great.pk)))
+            self.assertTrue(backend.has_perm(self.user, 'testapp.use',
+                TestModel.objects.get(pk=self.grandchild.pk)))
+        finally:
+            del settings.RUBBERSTAMP_PERMISSION_PARENTS_DEPTH
+
+
+class BackendTestSharedCache(RubberStampTestCase):
+    """Tests for ``RUBBERSTAMP_CACHE_BACKEND``."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json']
+    
+    def setUp(self):
+        self._original_backend = getattr(settings, 'RUBBERSTAMP_CACHE_BACKEND', None)
+        settings.RUBBERSTAMP_CACHE_BACKEND = 'locmem://'
+        # entries would outlive the rolled back test data
+        get_shared_cache().clear()
+        clear_group_rows_cache()
+        # load the closure of implied permissions ahead of counting queries
+        cache.get_implications()
+        self.backend = AppPermissionBackend()
+        self.group = Group.objects.get(pk=1)
+    
+    def tearDown(self):
+        get_shared_cache().clear()
+        clear_group_rows_cache()
+        settings.RUBBERSTAMP_CACHE_BACKEND = self._original_backend
+    
+    def perms(self, pk):
+        """Returns the permissions of a fresh instance of the given user."""
+        return self.backend.get_all_permissions(User.objects.get(pk=pk))
+    
+    def test_shared(self):
+        """Other instances (as in other processes) load from the shared cache."""
+        self.assertNumQueries(2, self.backend.has_module_perms, User.objects.get(pk=2), 'testapp')
+        user = User.objects.get(pk=2)
+        self.assertNumQueries(0, self.backend.has_module_perms, user, 'testapp')
+        self.assertEqual(self.backend.get_all_permissions(user),
+            set(['testapp.use.testapp.testmodel']))
+    
+    def test_group_entries_shared(self):
+        """Group permissions are cached once for all members."""
+        self.assertNumQueries(3, self.backend.has_module_perms, User.objects.get(pk=3), 'testapp')
+        user4 = User.objects.get(pk=4)
+        user4.groups.add(self.group)
+        self.assertNumQueries(2, self.backend.has_module_perms, User.objects.get(pk=4), 'testapp')
+        self.assertEqual(self.perms(4), set(['testapp.have.testapp.testmodel']))
+    
+    def test_group_rows_local(self):
+        """Group grants are kept in the process, but never past their version."""
+        self.assertEqual(self.perms(3), set(['testapp.have.testapp.testmodel']))
+        self.assertEqual(len(cache._group_grants), 1)
+        # only the versions are read from the shared cache
+        for key in cache._group_grants:
+            get_shared_cache().delete(key)
+        User.objects.get(pk=4).groups.add(self.group)
+        self.assertNumQueries(2, self.backend.has_module_perms, User.objects.get(pk=4), 'testapp')
+        self.assertEqual(self.perms(4), set(['testapp.have.testapp.testmodel']))
+        
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', self.group)
+        # the user's own entry is still current; only the group is reloaded
+        self.assertNumQueries(1, self.backend.has_module_perms, User.objects.get(pk=4), 'testapp')
+        self.assertEqual(self.perms(4), set(['testapp.use.testapp.testmodel', 'testapp.have.testapp.testmodel']))
+    
+    def test_grants(self):
+        """Rows are kept grouped by permission and content type."""
+        names = ('testapp', 'use', 'testapp', 'testmodel')
+        grants = cache.get_grants([(1, 2, 5, None) + names, (1, 2, None, None) + names,
+            (1, 2, 3, None) + names, (1, 3, None, u'x') + names])
+        (pair_names, is_type, ids, keys) = grants[(1, 2)]
+        self.assertEqual((pair_names, is_type, list(ids), keys), (names, True, [3, 5], ()))
+        (pair_names, is_type, ids, keys) = grants[(1, 3)]
+        self.assertEqual((is_type, list(ids), keys), (False, [], (u'x',)))
+    
+    def test_assign_invalidates(self):
+        self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel']))
+        AppPermission.objects.assign('testapp.have.testapp.testmodel', User.objects.get(pk=2))
+        self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel', 'testapp.have.testapp.testmodel']))
+        AppPermission.objects.remove('testapp.use.testapp.testmodel', User.objects.get(pk=2))
+        self.assertEqual(self.perms(2), set(['testapp.have.testapp.testmodel']))
+    
+    def test_group_assign_invalidates(self):
+        self.assertEqual(self.perms(3), set(['testapp.have.testapp.testmodel']))
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', self.group)
+        self.assertEqual(self.perms(3), set(['testapp.use.testapp.testmodel', 'testapp.have.testapp.testmodel']))
+    
+    def test_bulk_invalidates(self):
+        self.assertEqual(self.perms(4), set())
+        AppPermission.objects.assign_many('testapp.use.testapp.testmodel',
+            [User.objects.get(pk=4), self.group])
+        self.assertEqual(self.perms(4), set(['testapp.use.testapp.testmodel']))
+        self.assertTrue('testapp.use.testapp.testmodel' in self.perms(3))
+        AppPermission.objects.remove_many('testapp.use.testapp.testmodel', [self.group])
+        self.assertFalse('testapp.use.testapp.testmodel' in self.perms(3))
+    
+    def test_membership_invalidates(self):
+        self.assertEqual(self.perms(3), set(['testapp.have.testapp.testmodel']))
+        User.objects.get(pk=3).groups.clear()
+        self.assertEqual(self.perms(3), set())
+        self.group.user_set.add(User.objects.get(pk=3))
+        self.assertEqual(self.perms(3), set(['testapp.have.testapp.testmodel']))
+        self.group.user_set.clear()
+        self.assertEqual(self.perms(3), set())
+    
+    def test_rename_invalidates(self):
+        self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel']))
+        perm = AppPermission.objects.get(codename='use')
+        perm.codename = 'employ'
+        perm.save()
+        self.assertEqual(self.perms(2), set(['testapp.employ.testapp.testmodel']))
+    
+    def test_evicted_version(self):
+        """Losing a version never brings back an older entry."""
+        self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel']))
+        get_shared_cache().delete(VERSION_KEY % 'user.2')
+        AssignedPermission.objects.filter(user=2).update(user=4)
+        self.assertEqual(self.perms(2), set())
+
+
+
+class SharedCacheTransactionTest(RubberStampTestCase):
+    """Tests for ``RUBBERSTAMP_CACHE_BACKEND`` with real transactions."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json']
+    
+    def setUp(self):
+        self._original_backend = getattr(settings, 'RUBBERSTAMP_CACHE_BACKEND', None)
+        settings.RUBBERSTAMP_CACHE_BACKEND = 'locmem://'
+        get_shared_cache().clear()
+        clear_group_rows_cache()
+        self.backend = AppPermissionBackend()
+    
+    def tearDown(self):
+        get_shared_cache().clear()
+        clear_group_rows_cache()
+        settings.RUBBERSTAMP_CACHE_BACKEND = self._original_backend
+    
+    def perms(self, pk):
+        return self.backend.get_all_permissions(User.objects.get(pk=pk))
+    
+    def _fixture_setup(self):
+        TransactionTestCase._fixture_setup(self)
+    
+    def _fixture_teardown(self):
+        # the other tests expect the database as left by syncdb
+        call_command('flush', verbosity=0, interactive=False)
+        ContentType.objects.clear_cache()
+    
+    def test_assign_rolled_back(self):
+        """Assigning doesn't commit a transaction of the caller."""
+        def roll_back(func, *args):
+            func(*args)
+            transaction.rollback()
+        transaction.commit_manually(roll_back)(AppPermission.objects.assign,
+            'testapp.have.testapp.testmodel', User.objects.get(pk=2))
+        self.assertFalse(AssignedPermission.objects.filter(user=2, permission__codename='have').exists())
+        transaction.commit_manually(roll_back)(AppPermission.objects.remove,
+            'testapp.use.testapp.testmodel', User.objects.get(pk=2))
+        self.assertTrue(AssignedPermission.objects.filter(user=2, permission__codename='use').exists())
+    
+    def test_invalidated_after_commit(self):
+        """Entries cached before a change is committed don't outlive the commit."""
+        shared = get_shared_cache()
+        def current_key():
+            versions = cache._get_versions(shared, ['all', 'user.2'])
+            return ENTRY_KEY % ('user.2', versions['all'], versions['user.2'])
+        def recache(sender, instance, **kwargs):
+            # as a concurrent request would, not seeing the uncommitted change
+            shared.set(current_key(), stale)
+        def change(func, *args):
+            func(*args)
+            transaction.commit()
+        self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel']))
+        stale = shared.get(current_key())
+        signals.post_save.connect(recache, sender=AssignedPermission)
+        signals.post_delete.connect(recache, sender=AssignedPermission)
+        try:
+            transaction.commit_manually(change)(AppPermission.objects.assign,
+                'testapp.have.testapp.testmodel', User.objects.get(pk=2))
+            self.assertEqual(self.perms(2), set(['testapp.use.testapp.testmodel', 'testapp.have.testapp.testmodel']))
+            stale = shared.get(current_key())
+            transaction.commit_manually(change)(AppPermission.objects.remove,
+                'testapp.use.testapp.testmodel', User.objects.get(pk=2))
+            self.assertEqual(self.perms(2), set(['testapp.have.testapp.testmodel']))
+        finally:
+            signals.post_save.disconnect(recache, sender=AssignedPermission)
+            signals.post_delete.disconnect(recache, sender=AssignedPermission)
+
+
+class PermissionIndexTest(RubberStampTestCase):
+    """Tests for ``rubberstamp.cache.PermissionIndex``."""
+    
+    def test_lookups(self):
+        index = PermissionIndex([(1, 2, None), (1, 3, 10), (1, 3, 5), (2, 3, 7)])
+        self.assertTrue(index.has_type(1, 2))
+        self.assertFalse(index.has_type(1, 3))
+        self.assertTrue(index.has_object(1, 3, 5))
+        self.assertTrue(index.has_object(1, 3, 10))
+        self.assertFalse(index.has_object(1, 3, 7))
+        self.assertFalse(index.has_object(1, 3, 11))
+        self.assertFalse(index.has_object(1, 2, 5))
+        self.assertEqual(list(index.object_ids(1, 3)), [5, 10])
+        self.assertEqual(list(index.object_ids(3, 3)), [])
+    
+    def test_keys(self):
+        index = PermissionIndex([(1, 2, u'a'), (1, 2, 5)])
+        self.assertTrue(index.has_object(1, 2, 'a'))
+        self.assertTrue(index.has_object(1, 2, 5))
+        self.assertFalse(index.has_object(1, 2, '5'))
+        self.assertFalse(index.has_object(1, 3, 'a'))
+        self.assertTrue(index.has_any(1, 2))
+    
+    def test_memory_footprint(self):
+        """Many object-level assignments take a few bytes each."""
+        index = PermissionIndex([(1, 2, i) for i in range(200000)])
+        self.assertTrue(index.has_object(1, 2, 199999))
+        self.assertTrue(index.memory_footprint() < 200000 * 10)
+    
+    def test_user_permissions(self):
+        user = User.objects.create(username='indexed')
+        self.assertTrue(get_user_permissions(user).memory_footprint() > 0)
+
+
 __all__ = (
     'BackendTestNoneAssigned',
     'BackendTestTypeAssigned',
     'BackendTestObjectAssigned',
+    'BackendTestKeyedObject',
+    'BackendTestIntegerKeyedObject',
     'BackendTestBothAssigned',
     'BackendTestTypeByGroup',
     'BackendTestObjectByGroup',
     'BackendTestAnonymousUser',
+    'BackendTestCache',
+    'BackendTestInheritance',
+    'BackendTestSharedCache',
+    'SharedCacheTransactionTest',
+    'PermissionIndexTest',
 )
\ No newline at end of file
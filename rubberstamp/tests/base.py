@@ -2,9 +2,12 @@ import os
 
 from django.conf import settings
 from django.core.management import call_command
+from django.db import connection
 from django.db.models import loading
 from django.test import TestCase
 
+from rubberstamp.cache import clear_resolution_cache
+
 
 class RubberStampTestCase(TestCase):
     def _pre_setup(self):
@@ -26,6 +29,9 @@ class RubberStampTestCase(TestCase):
         settings.AUTHENTICATION_BACKENDS = list(settings.AUTHENTICATION_BACKENDS)
         settings.AUTHENTICATION_BACKENDS.append('rubberstamp.backends.AppPermissionBackend')
         
+        # resolved permissions would outlive the rolled back test data
+        clear_resolution_cache()
+        
         super(TestCase, self)._pre_setup()
     
     def _post_teardown(self):
@@ -35,3 +41,14 @@ class RubberStampTestCase(TestCase):
         settings.FIXTURE_DIRS = self._original_fixture_dirs
         settings.TEMPLATE_DIRS = self._original_template_dirs
         loading.cache.loaded = False
+    
+    def assertNumQueries(self, num, func, *args, **kwargs):
+        """Asserts that calling func executes exactly num queries."""
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        start = len(connection.queries)
+        try:
+            func(*args, **kwargs)
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual(len(connection.queries) - start, num)
@@ -1,9 +1,17 @@
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 
 from rubberstamp.tests.base import RubberStampTestCase
-from rubberstamp.models import AppPermission
+from rubberstamp.models import AppPermission, AssignedPermission
+from rubberstamp.exceptions import PermissionLookupError
 import rubberstamp
+from rubberstamp import discovery
+from rubberstamp.discovery import DISCOVERY_CACHE_KEY
 from rubberstamp.tests.testapp.models import TestModel
 from rubberstamp.tests.testapp import permissions as p
 
@@ -14,7 +22,7 @@ class DiscoveryTest(RubberStampTestCase):
     
     def tearDown(self):
         p.permissions = self._original_permissions[:]
-
+    
     def test_autodiscover_for_single_type(self):
         self.assertRaises(AppPermission.DoesNotExist,
             AppPermission.objects.get, app_label='testapp', codename='use')
@@ -23,7 +31,7 @@ class DiscoveryTest(RubberStampTestCase):
         ]
         rubberstamp.autodiscover()
         AppPermission.objects.get(app_label='testapp', codename='use')
-
+    
     def test_autodiscover_for_multiple_types(self):
         p.permissions = [
             ('use', 'Use this object', (TestModel, User)),
@@ -47,6 +55,222 @@ class DiscoveryTest(RubberStampTestCase):
         perm2 = AppPermission.objects.get(app_label='testapp', codename='use')
         self.assertEqual(perm2.description, 'Use this')
         self.assertEqual(perm1, perm2)
+    
+    def test_autodiscover_implies(self):
+        p.permissions = [
+            ('manage', 'Manage this object', TestModel, {'implies': ['edit']}),
+            ('edit', 'Edit this object', TestModel, {'implies': ['use']}),
+            ('use', 'Use this object', TestModel),
+        ]
+        rubberstamp.autodiscover()
+        manage = AppPermission.objects.get(app_label='testapp', codename='manage')
+        self.assertEqual([perm.codename for perm in manage.implies.all()], ['edit'])
+        user = User.objects.create(username='implied')
+        AppPermission.objects.assign('testapp.manage.testapp.testmodel', user)
+        # implied transitively
+        self.assertTrue(user.has_perm('testapp.use.testapp.testmodel'))
+        
+        p.permissions[0] = ('manage', 'Manage this object', TestModel,
+            {'implies': [('testapp', 'use')]})
+        p.permissions[1] = ('edit', 'Edit this object', TestModel)
+        rubberstamp.autodiscover()
+        self.assertEqual([perm.codename for perm in manage.implies.all()], ['use'])
+        self.assertEqual(len(AppPermission.objects.get(codename='edit').implies.all()), 0)
+        self.assertFalse(user.has_perm('testapp.edit.testapp.testmodel'))
+        self.assertTrue(user.has_perm('testapp.use.testapp.testmodel'))
+
+class SetBasedDiscoveryTest(RubberStampTestCase):
+    def setUp(self):
+        self._original_permissions = p.permissions[:]
+        self._original_skip = getattr(settings, 'RUBBERSTAMP_SKIP_UNCHANGED_DISCOVERY', False)
+        # warm Django's own ContentType cache
+        ContentType.objects.get_for_model(TestModel)
+        ContentType.objects.get_for_model(User)
+    
+    def tearDown(self):
+        p.permissions = self._original_permissions[:]
+        settings.RUBBERSTAMP_SKIP_UNCHANGED_DISCOVERY = self._original_skip
+        cache.delete(DISCOVERY_CACHE_KEY)
+    
+    def test_many_permissions(self):
+        p.permissions = [('perm%d' % i, 'Permission %d' % i, (TestModel, User))
+            for i in range(50)]
+        self.assertNumQueries(8, rubberstamp.autodiscover)
+        self.assertEqual(AppPermission.objects.filter(app_label='testapp').count(), 50)
+        perm = AppPermission.objects.get(app_label='testapp', codename='perm9')
+        self.assertEqual(perm.description, 'Permission 9')
+        self.assertEqual(len(perm.content_types.all()), 2)
+    
+    def test_unchanged(self):
+        p.permissions = [('use', 'Use this object', (TestModel, User))]
+        rubberstamp.autodiscover()
+        # only reads, and priming the lookup cache
+        self.assertNumQueries(5, rubberstamp.autodiscover)
+    
+    def test_changed(self):
+        p.permissions = [('use', 'Use this object', TestModel)]
+        rubberstamp.autodiscover()
+        p.permissions = [
+            ('use', 'Use this', TestModel),
+            ('use', 'Use this', User),
+            ('have', 'Have this object', User),
+        ]
+        rubberstamp.autodiscover()
+        perm = AppPermission.objects.get(app_label='testapp', codename='use')
+        self.assertEqual(perm.description, 'Use this')
+        self.assertEqual(len(perm.content_types.all()), 2)
+        self.assertEqual(len(AppPermission.objects.get(
+            app_label='testapp', codename='have').content_types.all()), 1)
+    
+    def test_skip_unchanged(self):
+        settings.RUBBERSTAMP_SKIP_UNCHANGED_DISCOVERY = True
+        p.permissions = [('use', 'Use this object', TestModel)]
+        rubberstamp.autodiscover()
+        self.assertNumQueries(0, rubberstamp.autodiscover)
+        p.permissions = [('use', 'Use this', TestModel)]
+        rubberstamp.autodiscover()
+        self.assertEqual(AppPermission.objects.get(
+            app_label='testapp', codename='use').description, 'Use this')
+
+
+class LazyDiscoveryTest(RubberStampTestCase):
+    """Tests for ``RUBBERSTAMP_AUTODISCOVER = 'lazy'``."""
+    fixtures = ['users.json']
+    
+    def setUp(self):
+        self._original_permissions = p.permissions[:]
+        self._original_mode = getattr(settings, 'RUBBERSTAMP_AUTODISCOVER', 'eager')
+        settings.RUBBERSTAMP_AUTODISCOVER = 'lazy'
+        p.permissions = [('use', 'Use this object', TestModel)]
+        self.user = User.objects.get(pk=2)
+    
+    def tearDown(self):
+        p.permissions = self._original_permissions[:]
+        settings.RUBBERSTAMP_AUTODISCOVER = self._original_mode
+        discovery._pending = None
+    
+    def test_no_queries(self):
+        """Discovery only reads the declarations."""
+        self.assertNumQueries(0, rubberstamp.autodiscover)
+        self.assertEqual(AppPermission.objects.count(), 0)
+    
+    def test_synced_on_first_use(self):
+        rubberstamp.autodiscover()
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel'))
+        self.assertEqual(AppPermission.objects.count(), 2)
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', self.user)
+        self.assertTrue(User.objects.get(pk=2).has_perm('testapp.use.testapp.testmodel'))
+        
+        # only synced once
+        self.assertFalse(discovery.sync_pending())
+        self.assertFalse(self.user.has_perm('testapp.nonexistent.testapp.testmodel'))
+        self.assertEqual(AppPermission.objects.count(), 2)
+    
+    def test_unknown_permission(self):
+        self.assertRaises(PermissionLookupError, AppPermission.objects.assign,
+            'testapp.use.testapp.testmodel', self.user)
+    
+    def test_command(self):
+        call_command('rubberstamp_sync', verbosity=0)
+        perm = AppPermission.objects.get(app_label='testapp', codename='use')
+        self.assertEqual(list(perm.content_types.all()),
+            [ContentType.objects.get_for_model(TestModel)])
+
+
+class SyncCommandTest(RubberStampTestCase):
+    """Tests for the ``rubberstamp_sync`` command."""
+    fixtures = ['users.json']
+    
+    def setUp(self):
+        self._original_permissions = p.permissions[:]
+        self._original_mode = getattr(settings, 'RUBBERSTAMP_AUTODISCOVER', 'eager')
+        p.permissions = [
+            ('use', 'Use this object', (TestModel, User)),
+            ('have', 'Have this object', TestModel),
+        ]
+        call_command('rubberstamp_sync', verbosity=0)
+        p.permissions = [
+            ('use', 'Use this', TestModel),
+            ('own', 'Own this object', TestModel),
+        ]
+        AppPermission.objects.assign('testapp.have.testapp.testmodel', User.objects.get(pk=2))
+    
+    def tearDown(self):
+        p.permissions = self._original_permissions[:]
+        settings.RUBBERSTAMP_AUTODISCOVER = self._original_mode
+    
+    def sync(self, **options):
+        out = StringIO()
+        call_command('rubberstamp_sync', stdout=out, **options)
+        return out.getvalue().splitlines()
+    
+    def test_dry_run(self):
+        """The diff is shown, but nothing is changed."""
+        self.assertEqual(self.sync(dry_run=True), [
+            'Adding permission testapp.own',
+            'Changing description of testapp.use: "Use this object" -> "Use this"',
+            'Adding testapp.own for testapp.testmodel',
+            'Stale (use --prune to delete) testapp.use for auth.user',
+            'Stale (use --prune to delete) permission testapp.have',
+        ])
+        self.assertEqual(AppPermission.objects.filter(app_label='testapp').count(), 2)
+        self.assertEqual(AppPermission.objects.get(codename='use').description,
+            'Use this object')
+    
+    def test_sync(self):
+        """Without pruning, stale permissions and content types are kept."""
+        self.sync()
+        self.assertEqual(AppPermission.objects.get(codename='use').description, 'Use this')
+        self.assertEqual(len(AppPermission.objects.get(codename='use').content_types.all()), 2)
+        self.assertEqual(len(AppPermission.objects.get(codename='own').content_types.all()), 1)
+        self.assertEqual(AssignedPermission.objects.count(), 1)
+        self.assertEqual(self.sync(), [
+            'Stale (use --prune to delete) testapp.use for auth.user',
+            'Stale (use --prune to delete) permission testapp.have',
+            'Permissions are up to date.',
+        ])
+    
+    def test_prune(self):
+        self.sync(prune=True)
+        self.assertEqual(list(AppPermission.objects.get(codename='use').content_types.all()),
+            [ContentType.objects.get_for_model(TestModel)])
+        self.assertRaises(AppPermission.DoesNotExist,
+            AppPermission.objects.get, codename='have')
+        self.assertEqual(AssignedPermission.objects.count(), 0)
+        self.assertEqual(self.sync(prune=True), ['Permissions are up to date.'])
+    
+    def test_implications(self):
+        p.permissions.append(('have', 'Have this object', TestModel, {'implies': ['use']}))
+        self.assertTrue('Adding implication of testapp.use by testapp.have'
+            in self.sync(prune=True))
+        self.assertEqual([perm.codename for perm in
+            AppPermission.objects.get(codename='have').implies.all()], ['use'])
+        p.permissions[-1] = ('have', 'Have this object', TestModel)
+        self.assertEqual(self.sync(dry_run=True), [
+            'Removing implication of testapp.use by testapp.have',
+        ])
+    
+    def test_concurrent_sync(self):
+        """Rows created meanwhile by another sync don't fail the diff."""
+        p.permissions.append(('have', 'Have this object', TestModel, {'implies': ['use']}))
+        diff = discovery.get_permission_diff(discovery.get_declared_permissions())
+        call_command('rubberstamp_sync', verbosity=0)
+        discovery.apply_permission_diff(diff)
+        self.assertEqual(AppPermission.objects.filter(codename='own').count(), 1)
+        self.assertEqual(len(AppPermission.objects.get(codename='own').content_types.all()), 1)
+        self.assertEqual([perm.codename for perm in
+            AppPermission.objects.get(codename='have').implies.all()], ['use'])
+        self.assertEqual(self.sync(dry_run=True), [
+            'Stale (use --prune to delete) testapp.use for auth.user',
+            'Permissions are up to date.',
+        ])
+    
+    def test_autodiscover_off(self):
+        settings.RUBBERSTAMP_AUTODISCOVER = 'off'
+        self.assertNumQueries(0, rubberstamp.autodiscover)
+        self.assertRaises(AppPermission.DoesNotExist,
+            AppPermission.objects.get, codename='own')
+
 
 class PermissionsTest(RubberStampTestCase):
     def test_rubberstamp_permissions(self):
@@ -61,4 +285,5 @@ class PermissionsTest(RubberStampTestCase):
         self.assertEqual(len(types), 1)
 
 
-__all__ = ('DiscoveryTest', 'PermissionsTest')
+__all__ = ('DiscoveryTest', 'SetBasedDiscoveryTest', 'LazyDiscoveryTest', 'SyncCommandTest',
+    'PermissionsTest')
@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.contrib.auth.models import User
+
+from rubberstamp.tests.base import RubberStampTestCase
+from rubberstamp.tests.testapp.models import TestModel
+from rubberstamp.instrumentation import StatsCollector
+from rubberstamp.middleware import PermissionStatsMiddleware
+from rubberstamp.signals import permission_checked
+from rubberstamp.utils import get_permission_targets
+
+
+class ListCollector(StatsCollector):
+    records = []
+    requests = []
+    
+    def record(self, name, duration, queries, cache_hits, cache_misses):
+        self.records.append((name, cache_hits, cache_misses))
+    
+    def record_request(self, request, summary):
+        self.requests.append(summary)
+
+
+class InstrumentationTest(RubberStampTestCase):
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned_object.json']
+    
+    def setUp(self):
+        self._original_settings = (
+            getattr(settings, 'RUBBERSTAMP_INSTRUMENTATION', False),
+            getattr(settings, 'RUBBERSTAMP_STATS_COLLECTORS', ()),
+        )
+        settings.RUBBERSTAMP_INSTRUMENTATION = True
+        settings.RUBBERSTAMP_STATS_COLLECTORS = (
+            'rubberstamp.tests.instrumentation.ListCollector',)
+        ListCollector.records = []
+        ListCollector.requests = []
+        self.sent = []
+        permission_checked.connect(self.receiver)
+        self.user = User.objects.get(pk=2)
+        self.object = TestModel.objects.get(pk=1)
+    
+    def tearDown(self):
+        permission_checked.disconnect(self.receiver)
+        (settings.RUBBERSTAMP_INSTRUMENTATION,
+            settings.RUBBERSTAMP_STATS_COLLECTORS) = self._original_settings
+    
+    def receiver(self, sender, **kwargs):
+        self.sent.append((sender, kwargs))
+    
+    def test_signal(self):
+        self.user.has_perm('testapp.use', obj=self.object)
+        self.user.has_module_perms('testapp')
+        get_permission_targets('testapp.use.testapp.testmodel', self.user)
+        self.assertEqual([name for (name, kwargs) in self.sent],
+            ['has_perm', 'has_module_perms', 'get_permission_targets'])
+        for (name, kwargs) in self.sent:
+            self.assertTrue(kwargs['duration'] >= 0)
+            self.assertEqual(kwargs['queries'], None)
+    
+    def test_collector(self):
+        self.user.has_perm('testapp.use', obj=self.object)
+        self.user.has_perm('testapp.use', obj=self.object)
+        # a miss each for the resolution and the user's permissions, then hits
+        self.assertEqual(ListCollector.records,
+            [('has_perm', 0, 2), ('has_perm', 2, 0)])
+    
+    def test_disabled(self):
+        settings.RUBBERSTAMP_INSTRUMENTATION = False
+        self.user.has_perm('testapp.use', obj=self.object)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(ListCollector.records, [])
+    
+    def test_middleware(self):
+        middleware = PermissionStatsMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.user.has_perm('testapp.use', obj=self.object)
+        self.user.has_perm('testapp.have', obj=self.object)
+        self.user.get_all_permissions()
+        middleware.process_response(request, HttpResponse())
+        stats = request.rubberstamp_stats
+        self.assertEqual(stats['has_perm']['calls'], 2)
+        self.assertEqual(stats['get_all_permissions']['calls'], 1)
+        self.assertEqual(ListCollector.requests, [stats])
+        
+        self.user.has_perm('testapp.use', obj=self.object)
+        self.assertEqual(stats['has_perm']['calls'], 2)
+
+
+__all__ = ('InstrumentationTest',)
@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from rubberstamp.tests.base import RubberStampTestCase
+from rubberstamp.models import AppPermission
+from rubberstamp.tests.testapp.models import TestModel
+
+
+class PermissionQuerySetTest(RubberStampTestCase):
+    """Tests for ``rubberstamp.managers.PermissionQuerySet``."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned_object.json']
+    
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        self.grouper = User.objects.get(pk=3)
+        self.object = TestModel.objects.get(pk=1)
+        self.other = TestModel.objects.create(name='other')
+    
+    def test_with_permission(self):
+        self.assertEqual(list(TestModel.objects.with_permission(self.user, 'testapp.use')),
+            [self.object])
+        self.assertEqual(list(TestModel.objects.with_permission(self.grouper, 'testapp.use')),
+            [])
+        self.assertEqual(list(TestModel.objects.with_permission(
+            self.grouper, 'testapp.have.testapp.testmodel')), [self.object])
+    
+    def test_with_permission_chained(self):
+        """The filter applies to an existing QuerySet, and can be chained."""
+        AppPermission.objects.assign('testapp.use', self.user, obj=self.other)
+        objects = TestModel.objects.filter(name='other')
+        self.assertEqual(list(objects.with_permission(self.user, 'testapp.use')), [self.other])
+        self.assertEqual(list(TestModel.objects.with_permission(self.user, 'testapp.use')
+            .exclude(name='other')), [self.object])
+    
+    def test_with_permission_type(self):
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', self.grouper)
+        self.assertEqual(list(TestModel.objects.with_permission(self.grouper, 'testapp.use')),
+            [self.object, self.other])
+    
+    def test_exists_strategy(self):
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        settings.RUBBERSTAMP_TARGETS_STRATEGY = 'exists'
+        try:
+            self.assertEqual(list(TestModel.objects.filter(name='')
+                .with_permission(self.grouper, 'testapp.have')), [self.object])
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+    
+    def test_with_permission_nested(self):
+        """The filtered QuerySet can be used as a subquery of another."""
+        child = TestModel.objects.create(parent=self.object)
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        try:
+            for strategy in ('in', 'exists'):
+                settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+                self.assertEqual(list(TestModel.objects.filter(parent__in=TestModel.objects
+                    .with_permission(self.user, 'testapp.use'))), [child])
+                self.assertEqual(list(TestModel.objects.filter(parent__in=TestModel.objects
+                    .with_permission(self.grouper, 'testapp.use'))), [])
+                self.assertEqual(list(TestModel.objects.filter(parent__in=TestModel.objects
+                    .with_permission(self.grouper, 'testapp.have')
+                    .annotate_permissions(self.grouper, ['testapp.use']))), [child])
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+    
+    def test_annotate_permissions(self):
+        """Permission flags are loaded with the objects, in one query."""
+        AppPermission.objects.assign('testapp.have.testapp.testmodel', self.user)
+        objects = TestModel.objects.order_by('pk').annotate_permissions(
+            self.user, ['testapp.use', 'testapp.have'])
+        # the permissions are resolved when annotating, not when evaluating
+        self.assertNumQueries(1, list, objects)
+        self.assertEqual([(bool(o.can_use), bool(o.can_have)) for o in objects],
+            [(True, True), (False, True)])
+        
+        objects = TestModel.objects.order_by('pk').annotate_permissions(
+            self.grouper, {'long': 'testapp.long.permission.name', 'have': 'testapp.have'})
+        self.assertEqual([(bool(o.long), bool(o.have)) for o in objects],
+            [(False, True), (False, False)])
+    
+    def test_annotate_chained(self):
+        objects = TestModel.objects.with_permission(self.grouper, 'testapp.have') \
+            .annotate_permissions(self.grouper, ['testapp.use'])
+        self.assertEqual([(o, bool(o.can_use)) for o in objects], [(self.object, False)])
+    
+    def test_annotate_joined(self):
+        """The columns are correlated with the model's own rows in a self-join."""
+        child = TestModel.objects.create(parent=self.other)
+        objects = TestModel.objects.filter(parent__name='other').annotate_permissions(
+            self.user, ['testapp.use'])
+        self.assertEqual([(o, bool(o.can_use)) for o in objects], [(child, False)])
+        AppPermission.objects.assign('testapp.use', self.user, obj=child)
+        self.assertEqual([(o, bool(o.can_use)) for o in objects.all()], [(child, True)])
+
+
+__all__ = ('PermissionQuerySetTest',)
@@ -1,10 +1,13 @@
+from django.db import transaction, IntegrityError
+from django.db.models import signals
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 
 from rubberstamp.tests.base import RubberStampTestCase
 from rubberstamp.models import AppPermission, AssignedPermission
-from rubberstamp.tests.testapp.models import TestModel
+from rubberstamp.tests.testapp.models import TestModel, KeyedTestModel
 from rubberstamp.exceptions import PermissionLookupError
+import rubberstamp
 
 
 class AssignTest(RubberStampTestCase):
@@ -290,6 +293,195 @@ class RemoveGroupTest(RubberStampTestCase):
         self.assertEqual(AssignedPermission.objects.all().count(), 4)
 
 
+class AssignManyTest(RubberStampTestCase):
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json']
+    
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        self.other = User.objects.get(pk=4)
+        self.group = Group.objects.get(pk=1)
+        self.objects = [TestModel.objects.get(pk=1), TestModel.objects.create()]
+        self.permission = AppPermission.objects.get(pk=1)
+    
+    def test_type(self):
+        created = AppPermission.objects.assign_many(
+            'testapp.use.testapp.testmodel', [self.user, self.other, self.group])
+        # user 2 already has the type-level permission
+        self.assertEqual(created, 2)
+        self.assertEqual(AssignedPermission.objects.filter(
+            permission=self.permission, object_id=None).count(), 3)
+        self.assertTrue(self.other.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_objects(self):
+        created = AppPermission.objects.assign_many(
+            'testapp.use', [self.user, self.group], self.objects)
+        self.assertEqual(created, 4)
+        self.assertEqual(AppPermission.objects.assign_many(
+            'testapp.use', [self.user, self.group], self.objects), 0)
+        for obj in self.objects:
+            self.assertTrue(self.user.has_perm('testapp.use', obj=obj))
+    
+    def test_no_objects(self):
+        self.assertEqual(AppPermission.objects.assign_many(
+            'testapp.use', [self.user], []), 0)
+    
+    def test_mismatched(self):
+        self.assertRaises(PermissionLookupError, AppPermission.objects.assign_many,
+            'testapp.use', [self.user], self.objects + [self.other])
+        self.assertEqual(AssignedPermission.objects.all().count(), 2)
+    
+    def test_no_user_or_group(self):
+        self.assertRaises(TypeError, AppPermission.objects.assign_many,
+            'testapp.use.testapp.testmodel', [self.user, None])
+    
+    def test_keyed_objects(self):
+        AppPermission.objects.get(codename='use').content_types.add(
+            ContentType.objects.get_for_model(KeyedTestModel))
+        objects = [KeyedTestModel.objects.create(key=key) for key in ('a', 'b')]
+        self.assertEqual(AppPermission.objects.assign_many(
+            'testapp.use', [self.user, self.group], objects), 4)
+        self.assertEqual(AppPermission.objects.assign_many(
+            'testapp.use', [self.user, self.group], objects), 0)
+        self.assertEqual(AssignedPermission.objects.filter(object_key='a').count(), 2)
+        self.assertTrue(self.user.has_perm('testapp.use', obj=objects[1]))
+        self.assertEqual(AppPermission.objects.remove_many(
+            'testapp.use', [self.user], objects[:1]), 1)
+        self.assertFalse(self.user.has_perm('testapp.use', obj=objects[0]))
+    
+    def test_remove(self):
+        AppPermission.objects.assign_many(
+            'testapp.use', [self.user, self.other], self.objects)
+        removed = AppPermission.objects.remove_many(
+            'testapp.use', [self.user, self.group], self.objects)
+        self.assertEqual(removed, 2)
+        self.assertFalse(AssignedPermission.objects.filter(
+            user=self.user, object_id__isnull=False).exists())
+        self.assertTrue(self.other.has_perm('testapp.use', obj=self.objects[0]))
+        # the type-level assignment is untouched, and still covers the objects
+        self.assertTrue(self.user.has_perm('testapp.use.testapp.testmodel'))
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.objects[0]))
+    
+    def test_update_assignments(self):
+        ct = ContentType.objects.get_for_model(TestModel)
+        (created, removed) = AppPermission.objects.update_assignments(
+            self.permission, ct, add=[self.other, self.group], remove=[self.user])
+        self.assertEqual((created, removed), (2, 1))
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel'))
+        self.assertTrue(self.other.has_perm('testapp.use.testapp.testmodel'))
+        
+        (created, removed) = AppPermission.objects.update_assignments(
+            self.permission, ct, add=[self.user], obj=self.objects[0])
+        self.assertEqual((created, removed), (1, 0))
+        self.assertTrue(self.user.has_perm('testapp.use', obj=self.objects[0]))
+        self.assertFalse(self.user.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_update_assignments_zero_pk(self):
+        """An object whose key is falsy is still not the type."""
+        ct = ContentType.objects.get_for_model(TestModel)
+        obj = TestModel.objects.create(pk=0)
+        AppPermission.objects.update_assignments(self.permission, ct, add=[self.other], obj=obj)
+        self.assertTrue(AssignedPermission.objects.filter(user=self.other, object_id=0).exists())
+        self.assertFalse(self.other.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_update_assignments_queries(self):
+        """Changing many principals takes the same few queries as changing one."""
+        ct = ContentType.objects.get_for_model(TestModel)
+        users = [User.objects.create(username='bulk%d' % i) for i in range(50)]
+        self.assertNumQueries(2, AppPermission.objects.update_assignments,
+            self.permission, ct, add=users[:1])
+        self.assertNumQueries(2, AppPermission.objects.update_assignments,
+            self.permission, ct, add=users[1:])
+    
+    def test_remove_queries(self):
+        """Removing from many principals takes a single query, and no signals."""
+        users = [User.objects.create(username='bulk%d' % i) for i in range(50)]
+        AppPermission.objects.assign_many('testapp.use', users, self.objects)
+        deleted = []
+        def record(sender, instance, **kwargs):
+            deleted.append(instance)
+        signals.post_delete.connect(record, sender=AssignedPermission)
+        try:
+            self.assertNumQueries(1, AppPermission.objects.remove_many,
+                'testapp.use', users, self.objects)
+        finally:
+            signals.post_delete.disconnect(record, sender=AssignedPermission)
+        self.assertEqual(deleted, [])
+        self.assertEqual(AppPermission.objects.remove_many('testapp.use', users, self.objects), 0)
+        self.assertFalse(users[0].has_perm('testapp.use', obj=self.objects[0]))
+    
+    def test_remove_type(self):
+        removed = AppPermission.objects.remove_many(
+            'testapp.have.testapp.testmodel', [self.user, self.group])
+        self.assertEqual(removed, 1)
+        self.assertEqual(AssignedPermission.objects.all().count(), 1)
+
+
+class UniqueAssignmentTest(RubberStampTestCase):
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json', 'assigned_object.json']
+    
+    def setUp(self):
+        self.object_type = ContentType.objects.get(app_label='testapp', model='testmodel')
+        self.permission = AppPermission.objects.get(pk=1)
+    
+    def assertDuplicateRejected(self, **kwargs):
+        kwargs.update(permission=self.permission, content_type=self.object_type)
+        sid = transaction.savepoint()
+        try:
+            AssignedPermission.objects.create(**kwargs)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        else:
+            self.fail('Duplicate assignment was created.')
+    
+    def test_object(self):
+        self.assertDuplicateRejected(user_id=2, object_id=1)
+    
+    def test_type(self):
+        self.assertDuplicateRejected(user_id=2, object_id=None)
+    
+    def test_group(self):
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', Group.objects.get(pk=1))
+        self.assertDuplicateRejected(group_id=1, object_id=None)
+
+
+class ResolutionCacheTest(RubberStampTestCase):
+    fixtures = ['users.json', 'objects.json', 'permissions.json']
+    
+    def setUp(self):
+        self.object = TestModel.objects.get(pk=1)
+        self.permission = AppPermission.objects.get(pk=1)
+        self.lookup = AppPermission.objects.get_permission_and_content_type
+    
+    def test_cached(self):
+        self.assertEqual(
+            self.lookup('testapp.use.testapp.testmodel')[0], self.permission)
+        self.assertNumQueries(0, self.lookup, 'testapp.use.testapp.testmodel')
+        self.assertEqual(
+            self.lookup('testapp.use', self.object)[0], self.permission)
+        self.assertNumQueries(0, self.lookup, 'testapp.use', self.object)
+    
+    def test_primed(self):
+        # warm Django's own ContentType cache
+        ContentType.objects.get_for_model(self.object)
+        rubberstamp.autodiscover()
+        self.assertNumQueries(0, self.lookup, 'testapp.use.testapp.testmodel')
+        self.assertNumQueries(0, self.lookup, 'testapp.use', self.object)
+        self.assertNumQueries(0, self.lookup,
+            'rubberstamp.manage.rubberstamp.apppermission')
+    
+    def test_content_types_change(self):
+        self.lookup('testapp.use.testapp.testmodel')
+        self.permission.content_types.clear()
+        self.assertRaises(PermissionLookupError,
+            self.lookup, 'testapp.use.testapp.testmodel')
+    
+    def test_delete(self):
+        self.lookup('testapp.use', self.object)
+        self.permission.delete()
+        self.assertRaises(PermissionLookupError,
+            self.lookup, 'testapp.use', self.object)
+
+
 __all__ = (
     'AssignTest',
     'AssignUserTest',
@@ -297,4 +489,7 @@ __all__ = (
     'AssignTestWithLongDottedCodename',
     'RemoveUserTest',
     'RemoveGroupTest',
+    'AssignManyTest',
+    'UniqueAssignmentTest',
+    'ResolutionCacheTest',
 )
@@ -1,9 +1,30 @@
 from django.db import models
 
+from rubberstamp.managers import PermissionManager
+
 
 class TestModel(models.Model):
-    pass
+    name = models.CharField(max_length=100, blank=True)
+    parent = models.ForeignKey('self', null=True, blank=True)
+    
+    objects = PermissionManager()
 
 
 class OtherTestModel(models.Model):
     pass
+
+
+class KeyedTestModel(models.Model):
+    key = models.CharField(max_length=20, primary_key=True)
+
+
+class BigKeyedTestModel(models.Model):
+    key = models.BigIntegerField(primary_key=True)
+    
+    objects = PermissionManager()
+
+
+class SignedKeyedTestModel(models.Model):
+    key = models.IntegerField(primary_key=True)
+    
+    objects = PermissionManager()
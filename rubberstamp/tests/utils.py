@@ -1,11 +1,16 @@
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 
 from rubberstamp.tests.base import RubberStampTestCase
-from rubberstamp.models import AppPermission
-from rubberstamp.tests.testapp.models import TestModel
+from rubberstamp.models import AppPermission, AssignedPermission
+from rubberstamp.backends import AppPermissionBackend
+from rubberstamp.tests.testapp.models import TestModel, KeyedTestModel
 from rubberstamp.exceptions import PermissionLookupError
-from rubberstamp.utils import get_permission_targets, get_app_list
+from rubberstamp.utils import get_permission_targets, get_app_list, get_perm_q_for_user, \
+    has_perm_for_objects, filter_allowed, get_permission_tree
+from rubberstamp.cache import clear_permission_tree_cache, get_implications
+from rubberstamp.discovery import autodiscover
 
 
 class GetPermissionTargetsTest(RubberStampTestCase):
@@ -36,6 +41,155 @@ class GetPermissionTargetsTest(RubberStampTestCase):
             'testapp.use.testapp.testmodel', grouper)), 0)
         self.assertEqual(len(get_permission_targets(
             'testapp.have.testapp.testmodel', grouper)), 1)
+    
+    def test_type_assigned(self):
+        """A type-level assignment covers every object of the type."""
+        user = User.objects.get(pk=2)
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', user)
+        TestModel.objects.create()
+        self.assertEqual(list(get_permission_targets('testapp.use.testapp.testmodel', user)),
+            list(TestModel.objects.all()))
+    
+    def test_strategies(self):
+        """Both filtering strategies find the same objects."""
+        grouper = User.objects.get(pk=3)
+        user = User.objects.get(pk=2)
+        AppPermission.objects.assign('testapp.have', user, obj=TestModel.objects.create())
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        try:
+            for strategy in ('in', 'exists'):
+                settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+                self.assertEqual(list(get_permission_targets(
+                    'testapp.have.testapp.testmodel', grouper)), [TestModel.objects.get(pk=1)])
+                self.assertEqual(len(get_permission_targets(
+                    'testapp.have.testapp.testmodel', user)), 1)
+                self.assertEqual(len(get_permission_targets(
+                    'testapp.use.testapp.testmodel', grouper)), 0)
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+    
+    def test_nested(self):
+        """The targets can be used as a subquery of another query."""
+        user = User.objects.get(pk=2)
+        child = TestModel.objects.create(parent=TestModel.objects.get(pk=1))
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        try:
+            for strategy in ('in', 'exists'):
+                settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+                self.assertEqual(list(TestModel.objects.filter(parent__in=get_permission_targets(
+                    'testapp.use.testapp.testmodel', user))), [child])
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+    
+    def test_queries(self):
+        """The type-level check is answered from the backend's cache if loaded."""
+        user = User.objects.get(pk=2)
+        permission = 'testapp.use.testapp.testmodel'
+        get_permission_targets(permission, user)
+        self.assertNumQueries(2, lambda: list(get_permission_targets(permission, user)))
+        AppPermissionBackend().has_module_perms(user, 'testapp')
+        self.assertNumQueries(1, lambda: list(get_permission_targets(permission, user)))
+    
+    def test_non_integer_pk(self):
+        user = User.objects.get(pk=2)
+        obj = KeyedTestModel.objects.create(key='a')
+        KeyedTestModel.objects.create(key='b')
+        perm = AppPermission.objects.get(codename='use')
+        perm.content_types.add(ContentType.objects.get_for_model(KeyedTestModel))
+        permission = 'testapp.use.testapp.keyedtestmodel'
+        self.assertEqual(len(get_permission_targets(permission, user)), 0)
+        AppPermission.objects.assign('testapp.use', user, obj=obj)
+        original_strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+        try:
+            for strategy in ('in', 'exists'):
+                settings.RUBBERSTAMP_TARGETS_STRATEGY = strategy
+                self.assertEqual(list(get_permission_targets(permission, user)), [obj])
+        finally:
+            settings.RUBBERSTAMP_TARGETS_STRATEGY = original_strategy
+        self.assertEqual(filter_allowed('testapp.use', user, KeyedTestModel.objects.all()),
+            [obj])
+        AppPermission.objects.assign(permission, user)
+        self.assertEqual(len(get_permission_targets(permission, user)), 2)
+
+
+class HasPermForObjectsTest(RubberStampTestCase):
+    """Tests for ``rubberstamp.utils.has_perm_for_objects``."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned_object.json']
+    
+    def setUp(self):
+        self.user = User.objects.get(pk=2)
+        self.grouper = User.objects.get(pk=3)
+        self.objects = [TestModel.objects.get(pk=1), TestModel.objects.create()]
+        # resolve the permission (and what implies it) ahead of counting queries
+        AppPermission.objects.get_permission_and_content_type(
+            'testapp.use.testapp.testmodel', self.objects[0])
+        get_implications()
+    
+    def test_object_assigned(self):
+        allowed = has_perm_for_objects('testapp.use', self.user, self.objects)
+        self.assertEqual(allowed, {self.objects[0].pk: True, self.objects[1].pk: False})
+        self.assertEqual(filter_allowed('testapp.use', self.user, self.objects),
+            [self.objects[0]])
+    
+    def test_group_assigned(self):
+        self.assertEqual(
+            filter_allowed('testapp.use', self.grouper, self.objects), [])
+        self.assertEqual(
+            filter_allowed('testapp.have', self.grouper, self.objects),
+            [self.objects[0]])
+    
+    def test_type_assigned(self):
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', self.user)
+        self.assertEqual(
+            filter_allowed('testapp.use', self.user, TestModel.objects.all()),
+            list(TestModel.objects.all()))
+    
+    def test_single_query(self):
+        self.assertNumQueries(1, has_perm_for_objects,
+            'testapp.use.testapp.testmodel', self.user, self.objects)
+    
+    def test_cached(self):
+        AppPermissionBackend().has_module_perms(self.user, 'testapp')
+        self.assertNumQueries(0, has_perm_for_objects,
+            'testapp.use.testapp.testmodel', self.user, self.objects)
+    
+    def test_no_objects(self):
+        self.assertEqual(has_perm_for_objects('testapp.use', self.user, []), {})
+
+
+class ExpandGroupsTest(RubberStampTestCase):
+    """Tests for ``RUBBERSTAMP_EXPAND_GROUPS``."""
+    fixtures = ['users.json', 'objects.json', 'permissions.json', 'assigned.json', 'assigned_object.json']
+    
+    def setUp(self):
+        self._original_expand = getattr(settings, 'RUBBERSTAMP_EXPAND_GROUPS', False)
+        settings.RUBBERSTAMP_EXPAND_GROUPS = True
+        self.user = User.objects.get(pk=2)
+        self.grouper = User.objects.get(pk=3)
+        self.object = TestModel.objects.get(pk=1)
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_EXPAND_GROUPS = self._original_expand
+    
+    def assigned(self, user):
+        return AssignedPermission.objects.filter(get_perm_q_for_user(user)).count()
+    
+    def test_group_ids_loaded_once(self):
+        self.assertNumQueries(2, self.assigned, self.grouper)
+        self.assertNumQueries(1, self.assigned, self.grouper)
+        self.assertEqual(self.assigned(self.grouper), 2)
+    
+    def test_no_groups(self):
+        self.assertEqual(self.assigned(self.user), 2)
+    
+    def test_membership_change(self):
+        self.assertTrue(self.grouper.has_perm('testapp.have', obj=self.object))
+        self.grouper.groups.clear()
+        self.assertEqual(self.assigned(self.grouper), 0)
+        self.assertFalse(self.grouper.has_perm('testapp.have', obj=self.object))
+        self.user.groups.add(Group.objects.get(pk=1))
+        self.assertEqual(self.assigned(self.user), 4)
+        self.assertTrue(self.user.has_perm('testapp.have', obj=self.object))
 
 
 class GetAppsTest(RubberStampTestCase):
@@ -68,7 +222,63 @@ class GetAppsTest(RubberStampTestCase):
         self.assertTrue(all(a in apps for a in ['testapp', 'rubberstamp']))
 
 
+class GetPermissionTreeTest(RubberStampTestCase):
+    """Tests for ``rubberstamp.utils.get_permission_tree``."""
+    fixtures = ['permissions.json']
+    
+    def setUp(self):
+        self._original_cache_tree = getattr(settings, 'RUBBERSTAMP_CACHE_PERMISSION_TREE', False)
+        clear_permission_tree_cache()
+        self.tm_ct = ContentType.objects.get(app_label='testapp', model='testmodel')
+        self.otm_ct = ContentType.objects.get(app_label='testapp', model='othertestmodel')
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_CACHE_PERMISSION_TREE = self._original_cache_tree
+        clear_permission_tree_cache()
+    
+    def test_tree(self):
+        """Permissions are grouped by app, with the types they apply to."""
+        AppPermission.objects.create(app_label='other', codename='untyped')
+        AppPermission.objects.get(codename='use').content_types.add(self.otm_ct)
+        apps = get_permission_tree()
+        self.assertEqual([a['label'] for a in apps], ['other', 'testapp'])
+        self.assertEqual(apps[0]['perms'], [{'codename': 'untyped', 'types': []}])
+        self.assertEqual([(p['codename'], p['types']) for p in apps[1]['perms']], [
+            ('have', [self.tm_ct]),
+            ('long.permission.name', [self.tm_ct]),
+            ('use', [self.otm_ct, self.tm_ct]),
+        ])
+    
+    def test_query_count(self):
+        """The number of queries does not grow with the number of permissions."""
+        self.assertNumQueries(2, get_permission_tree)
+        for i in range(20):
+            perm = AppPermission.objects.create(app_label='testapp', codename='perm%d' % i)
+            perm.content_types.add(self.tm_ct)
+        self.assertNumQueries(2, get_permission_tree)
+    
+    def test_cached(self):
+        """With the setting on, the tree is cached until permissions change."""
+        settings.RUBBERSTAMP_CACHE_PERMISSION_TREE = True
+        get_permission_tree()
+        self.assertNumQueries(0, get_permission_tree)
+        
+        AppPermission.objects.get(codename='use').content_types.add(self.otm_ct)
+        apps = get_permission_tree()
+        self.assertEqual(apps[0]['perms'][2]['types'], [self.otm_ct, self.tm_ct])
+        self.assertNumQueries(0, get_permission_tree)
+        
+        AppPermission.objects.create(app_label='other', codename='new')
+        self.assertEqual(get_permission_tree()[0]['label'], 'other')
+        
+        autodiscover()
+        self.assertNumQueries(2, get_permission_tree)
+
+
 __all__ = (
     'GetPermissionTargetsTest',
+    'HasPermForObjectsTest',
+    'ExpandGroupsTest',
     'GetAppsTest',
+    'GetPermissionTreeTest',
 )
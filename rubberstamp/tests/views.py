@@ -1,9 +1,13 @@
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 
 from rubberstamp.tests.base import RubberStampTestCase
 from rubberstamp.models import AppPermission
-from rubberstamp.tests.testapp.models import TestModel
+from rubberstamp.cache import get_implications
+from rubberstamp.tests.testapp.models import TestModel, KeyedTestModel
 
 
 class ViewTest(RubberStampTestCase):
@@ -134,6 +138,30 @@ class ViewTest(RubberStampTestCase):
         user5 = User.objects.get(pk=5)
         self.assertFalse(user5.has_perm('testapp.use.testapp.testmodel'))
     
+    def test_type_post_queries(self):
+        """Changing many principals takes no more queries than changing a few."""
+        AppPermission.objects.assign('rubberstamp.manage.rubberstamp.apppermission', self.user)
+        self.client.login(username='user', password='')
+        ids = [str(User.objects.create(username='bulk%d' % i).pk) for i in range(30)]
+        
+        def count_queries(post_dict):
+            old_debug = settings.DEBUG
+            settings.DEBUG = True
+            start = len(connection.queries)
+            try:
+                self.client.post('/testapp.use.testapp.testmodel/', post_dict)
+            finally:
+                settings.DEBUG = old_debug
+            return len(connection.queries) - start
+        
+        # load the closure of implied permissions ahead of counting queries
+        get_implications()
+        few = count_queries({'users': ids[:2]})
+        self.client.post('/testapp.use.testapp.testmodel/', {})
+        many = count_queries({'users': ids})
+        self.assertEqual(many, few)
+        self.assertTrue(User.objects.get(pk=ids[-1]).has_perm('testapp.use.testapp.testmodel'))
+    
     def test_object_list(self):
         """Given a permission and type, return a list of objects of that type."""
         xr = self.client.get('/testapp.use.testapp.nomodel/objects/')
@@ -179,6 +207,9 @@ class ViewTest(RubberStampTestCase):
         # nonexistent should raise 404
         xr = self.client.get('/testapp.use.testapp.testmodel/objects/100/')
         self.assertEqual(xr.status_code, 404)
+        # as should a key which isn't one of the type
+        xr = self.client.get('/testapp.use.testapp.testmodel/objects/abc/')
+        self.assertEqual(xr.status_code, 404)
         r = self.client.get('/testapp.use.testapp.testmodel/objects/1/')
         self.assertEqual(r.status_code, 200)
         
@@ -197,6 +228,20 @@ class ViewTest(RubberStampTestCase):
         obj = TestModel.objects.get(pk=1)
         self.assertTrue(user4.has_perm('testapp.use.testapp.testmodel', obj=obj))
     
+    def test_keyed_object_to_user(self):
+        """Assign a permission for an object with a text primary key."""
+        AppPermission.objects.get(codename='use').content_types.add(
+            ContentType.objects.get_for_model(KeyedTestModel))
+        obj = KeyedTestModel.objects.create(key='doc-1')
+        AppPermission.objects.assign('rubberstamp.manage.rubberstamp.apppermission', self.user)
+        self.client.login(username='user', password='')
+        rp = self.client.post('/testapp.use.testapp.keyedtestmodel/objects/doc-1/',
+            {'users': ['4']})
+        self.assertEqual(rp.status_code, 200)
+        self.assertTrue(User.objects.get(pk=4).has_perm('testapp.use', obj=obj))
+        r = self.client.get('/testapp.use.testapp.keyedtestmodel/objects/doc-1/')
+        self.assertEqual([u.pk for u in r.context['assign_form'].initial['users']], [4])
+    
     def test_form_preselection(self):
         AppPermission.objects.assign('rubberstamp.manage.rubberstamp.apppermission', self.user)
         self.client.login(username='user', password='')
@@ -222,4 +267,139 @@ class ViewTest(RubberStampTestCase):
         self.assertEqual(form.initial['users'], [user4])
 
 
-__all__ = ('ViewTest',)
+
+class ObjectListTest(RubberStampTestCase):
+    """Tests for paging, searching and streaming in the object list view."""
+    fixtures = ['users.json', 'view_objects.json', 'view_permissions.json']
+    urls = 'rubberstamp.tests.testurls'
+    
+    def setUp(self):
+        self._original_per_page = getattr(settings, 'RUBBERSTAMP_OBJECTS_PER_PAGE', 100)
+        self._original_search_fields = getattr(settings, 'RUBBERSTAMP_SEARCH_FIELDS', {})
+        settings.RUBBERSTAMP_OBJECTS_PER_PAGE = 2
+        settings.RUBBERSTAMP_SEARCH_FIELDS = {'testapp.testmodel': ('^name',)}
+        for name in ('apple', 'banana', 'avocado'):
+            TestModel.objects.create(name=name)
+        user = User.objects.get(username='user')
+        AppPermission.objects.assign('rubberstamp.manage.rubberstamp.apppermission', user)
+        self.client.login(username='user', password='')
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_OBJECTS_PER_PAGE = self._original_per_page
+        settings.RUBBERSTAMP_SEARCH_FIELDS = self._original_search_fields
+    
+    def test_paging(self):
+        """Objects are paged on their primary key."""
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/')
+        self.assertEqual([o.pk for o in r.context['objects']], [1, 2])
+        self.assertEqual(r.context['next_after'], 2)
+        
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'after': 2})
+        self.assertEqual([o.pk for o in r.context['objects']], [3, 4])
+        self.assertEqual(r.context['next_after'], 4)
+        
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'after': 4})
+        self.assertEqual([o.pk for o in r.context['objects']], [5])
+        self.assertEqual(r.context['next_after'], None)
+        
+        xr = self.client.get('/testapp.use.testapp.testmodel/objects/', {'after': 'x'})
+        self.assertEqual(xr.status_code, 404)
+    
+    def test_search(self):
+        """Objects can be searched on the configured fields."""
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'q': 'a'})
+        self.assertEqual([o.name for o in r.context['objects']], ['apple', 'avocado'])
+        self.assertEqual(r.context['next_after'], None)
+        self.assertEqual(r.context['query'], 'a')
+        
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'q': 'AV'})
+        self.assertEqual([o.name for o in r.context['objects']], ['avocado'])
+        
+        # without search fields, the search string is ignored
+        settings.RUBBERSTAMP_SEARCH_FIELDS = {}
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'q': 'a'})
+        self.assertEqual(len(r.context['objects']), 2)
+        self.assertEqual(r.context['next_after'], 2)
+    
+    def test_stream(self):
+        """All objects can be streamed a page at a time."""
+        r = self.client.get('/testapp.use.testapp.testmodel/objects/', {'stream': 1})
+        self.assertEqual(r.status_code, 200)
+        # a streamed response can only be consumed once
+        content = r.content
+        for pk in range(1, 6):
+            self.assertTrue('/testapp.use.testapp.testmodel/objects/%d/' % pk in content)
+        
+        content = self.client.get('/testapp.use.testapp.testmodel/objects/',
+            {'stream': 1, 'q': 'b'}).content
+        self.assertTrue('/testapp.use.testapp.testmodel/objects/4/' in content)
+        self.assertFalse('/testapp.use.testapp.testmodel/objects/3/' in content)
+
+
+
+class DeltaAssignmentTest(RubberStampTestCase):
+    """Tests for ``RUBBERSTAMP_DELTA_ASSIGNMENT`` and the principal lookup."""
+    fixtures = ['users.json', 'view_objects.json', 'view_permissions.json']
+    urls = 'rubberstamp.tests.testurls'
+    
+    def setUp(self):
+        self._original_delta = getattr(settings, 'RUBBERSTAMP_DELTA_ASSIGNMENT', False)
+        settings.RUBBERSTAMP_DELTA_ASSIGNMENT = True
+        user = User.objects.get(username='user')
+        AppPermission.objects.assign('rubberstamp.manage.rubberstamp.apppermission', user)
+        self.client.login(username='user', password='')
+    
+    def tearDown(self):
+        settings.RUBBERSTAMP_DELTA_ASSIGNMENT = self._original_delta
+    
+    def test_add_remove(self):
+        """Only the posted principals are added or removed."""
+        user5 = User.objects.get(pk=5)
+        AppPermission.objects.assign('testapp.use.testapp.testmodel', user5)
+        r = self.client.get('/testapp.use.testapp.testmodel/')
+        self.assertEqual(list(r.context['assigned_users']), [user5])
+        
+        rp = self.client.post('/testapp.use.testapp.testmodel/',
+            {'add_users': ['4'], 'add_groups': ['1']})
+        self.assertTrue(rp.context['assign_form'].is_valid())
+        self.assertEqual(list(rp.context['assigned_users']),
+            list(User.objects.filter(pk__in=[4, 5]).order_by('username')))
+        self.assertEqual(list(rp.context['assigned_groups']), [Group.objects.get(pk=1)])
+        self.assertTrue(User.objects.get(pk=4).has_perm('testapp.use.testapp.testmodel'))
+        
+        rp = self.client.post('/testapp.use.testapp.testmodel/', {'remove_users': ['5']})
+        self.assertFalse(User.objects.get(pk=5).has_perm('testapp.use.testapp.testmodel'))
+        self.assertTrue(User.objects.get(pk=4).has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_object(self):
+        obj = TestModel.objects.get(pk=1)
+        self.client.post('/testapp.use.testapp.testmodel/objects/1/', {'add_users': ['4']})
+        user4 = User.objects.get(pk=4)
+        self.assertTrue(user4.has_perm('testapp.use.testapp.testmodel', obj=obj))
+        self.assertFalse(user4.has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_invalid(self):
+        """Unknown principals invalidate the form, and nothing is changed."""
+        rp = self.client.post('/testapp.use.testapp.testmodel/',
+            {'add_users': ['4', '100']})
+        self.assertFalse(rp.context['assign_form'].is_valid())
+        self.assertFalse(User.objects.get(pk=4).has_perm('testapp.use.testapp.testmodel'))
+    
+    def test_lookup(self):
+        """Users and groups can be looked up by name prefix."""
+        r = self.client.get('/lookup/users/', {'q': 'permtest'})
+        self.assertEqual(simplejson.loads(r.content), [
+            {'id': 4, 'name': 'permtest4'},
+            {'id': 5, 'name': 'permtest5'},
+        ])
+        r = self.client.get('/lookup/groups/', {'q': 'gr'})
+        self.assertEqual(simplejson.loads(r.content), [{'id': 1, 'name': 'group'}])
+        r = self.client.get('/lookup/users/', {'q': 'nobody'})
+        self.assertEqual(simplejson.loads(r.content), [])
+        
+        self.client.logout()
+        xr = self.client.get('/lookup/users/', {'q': 'permtest'})
+        self.assertEqual(xr.status_code, 302)
+
+
+__all__ = ('ViewTest', 'ObjectListTest', 'DeltaAssignmentTest')
@@ -1,7 +1,7 @@
 from django.conf.urls.defaults import *
 from django.contrib.auth.decorators import permission_required
 
-from rubberstamp.views import app_list, object_list, type_perms
+from rubberstamp.views import app_list, object_list, type_perms, principal_lookup
 
 
 manage_perm = 'rubberstamp.manage.rubberstamp.apppermission'
@@ -16,7 +16,10 @@ urlpatterns = patterns('',
     (r'^(\w+)\.(\w+)\.(\w+)\.(\w+)/objects/$', 
         permission_required(manage_perm)(object_list),
         {}, 'rubberstamp_object_list'),
-    (r'^(\w+)\.(\w+)\.(\w+)\.(\w+)/objects/(\d+)/$', 
+    (r'^(\w+)\.(\w+)\.(\w+)\.(\w+)/objects/([^/]+)/$', 
         permission_required(manage_perm)(type_perms),
         {}, 'rubberstamp_object_perms'),
+    (r'^lookup/(users|groups)/$',
+        permission_required(manage_perm)(principal_lookup),
+        {}, 'rubberstamp_principal_lookup'),
 )
@@ -1,5 +1,16 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, router, transaction
 from django.db.models import Q
 from django.db.models.loading import get_model
+from django.db.models.sql import DeleteQuery
+from django.db.models.sql.where import AND
+from django.utils.encoding import force_unicode
+
+from rubberstamp.instrumentation import instrumented
+
+# the attribute caching the keys of an object's ancestors, with its parent's
+PARENTS_ATTR = '_rubberstamp_parents'
 
 
 def get_perm_q_for_user(user):
@@ -7,33 +18,592 @@ def get_perm_q_for_user(user):
     Returns a Q object for the given user, to be used as a filter on
     `AppPermission`, which will return permissions that this user possesses
     directly and through group membership.
+    
+    With ``RUBBERSTAMP_EXPAND_GROUPS`` on, the user's group ids are loaded
+    once per user instance and given as a flat list, instead of a subquery on
+    the user's groups in every query.
     """
     
     if user.is_anonymous():
         # anonymous users have no perms
         return Q(pk=None)
+    if getattr(settings, 'RUBBERSTAMP_EXPAND_GROUPS', False):
+        from rubberstamp.cache import get_user_group_ids
+        group_ids = get_user_group_ids(user)
+        if not group_ids:
+            return Q(user=user)
+        return Q(user=user) | Q(group__in=group_ids)
     return Q(user=user) | Q(group__in=user.groups.all())
 
 
+@instrumented('get_permission_targets')
 def get_permission_targets(permission, user):
     """
     Given a (long) permission string and a user, returns a QuerySet of
     objects for which that user has that permission.
+    
+    If the user has the permission for the type itself, every object of the
+    type is returned. Otherwise the objects are filtered on the user's
+    assignments, with either a correlated ``EXISTS`` (``'exists'``) or an
+    ``IN`` subquery (``'in'``), as set by ``RUBBERSTAMP_TARGETS_STRATEGY``.
+    By default, ``'in'`` is used on SQLite, which materializes the subquery
+    once, and ``'exists'`` elsewhere. Objects whose integer keys are stored
+    as text (see `get_object_field`) are always filtered with ``EXISTS``.
+    
+    The QuerySet is lazy, so with instrumentation on, the recorded figures
+    cover only resolving the permission and the type-level check, not the
+    query for the objects.
     """
     
     (perm, ct) = get_model('rubberstamp', 'apppermission').objects.get_permission_and_content_type(permission)
+    return filter_permission_targets(ct.model_class()._default_manager.all(), perm, ct, user)
+
+
+def filter_permission_targets(queryset, perm, ct, user):
+    """
+    Filters the given QuerySet to the objects for which the given user has
+    the given `AppPermission`, as in `get_permission_targets`. The
+    permission and `ContentType` are given already resolved.
+    
+    Objects inheriting the permission from an ancestor (see
+    `get_parent_levels`) are included, through a condition on the key of
+    each ancestor the user could inherit it from.
+    """
+    
+    TargetClass = queryset.model
+    if _has_type_permission(perm, ct, user):
+        return queryset
+    
+    assigned = get_assigned_for_user(perm, ct, user)
+    inherited = get_inherited_q(TargetClass, perm, user)
+    if inherited is None:
+        return _filter_assigned(queryset, assigned)
+    direct = _filter_assigned(TargetClass._base_manager.using(queryset.db), assigned)
+    return queryset.filter(Q(pk__in=direct.values('pk')) | inherited)
+
+
+def _filter_assigned(queryset, assigned):
+    """
+    Filters the given QuerySet to the objects the given AssignedPermissions
+    are for, with the strategy set by ``RUBBERSTAMP_TARGETS_STRATEGY``.
+    """
+    
+    TargetClass = queryset.model
+    strategy = getattr(settings, 'RUBBERSTAMP_TARGETS_STRATEGY', None)
+    if strategy is None:
+        if connections[queryset.db].settings_dict['ENGINE'].endswith('sqlite3'):
+            strategy = 'in'
+        else:
+            strategy = 'exists'
+    field = get_object_field(TargetClass)
+    if strategy == 'in' and (field == 'object_id' or _has_text_pk(TargetClass)):
+        return queryset.filter(pk__in=assigned.filter(
+            **{'%s__isnull' % field: False}).values(field))
+    
+    queryset = queryset._clone()
+    queryset.query.where.add(AssignedExists(assigned, TargetClass,
+        queryset.query.get_initial_alias()), AND)
+    return queryset
+
+
+def get_inherited_q(model, perm, user):
+    """
+    Returns a Q object matching the objects of the given model which inherit
+    the given `AppPermission` from one of their ancestors, as `has_perm`
+    does, or None if the user has it for no ancestor type or object.
+    
+    Which ancestor types the permission is assigned for (or for objects of)
+    is read from the backend's cache if loaded, or with two queries.
+    """
+    
+    levels = get_parent_levels(model)
+    if not levels:
+        return None
+    ct_ids = get_parent_content_types(model)
+    
+    from rubberstamp.cache import get_cached_user_permissions
+    assigned = get_model('rubberstamp', 'assignedpermission').objects.filter(
+        get_perm_q_for_user(user), _get_permission_q(perm))
+    cached = get_cached_user_permissions(user)
+    if cached is not None:
+        any_cts = set([ct_id for ct_id in ct_ids if cached.index.has_any(perm.pk, ct_id)])
+        type_cts = set([ct_id for ct_id in any_cts if cached.index.has_type(perm.pk, ct_id)])
+    else:
+        any_cts = set(assigned.filter(content_type__in=ct_ids)
+            .values_list('content_type', flat=True).distinct())
+        type_cts = set()
+        if any_cts:
+            type_cts = set(assigned.filter(content_type__in=list(any_cts),
+                object_id__isnull=True, object_key__isnull=True)
+                .values_list('content_type', flat=True).distinct())
+    
+    from django.contrib.contenttypes.models import ContentType
+    q = None
+    for (lookup, ct_id) in levels:
+        if ct_id not in any_cts:
+            continue
+        if ct_id in type_cts:
+            level_q = Q(**{'%s__isnull' % lookup: False})
+        else:
+            level_q = Q(**{'%s__in' % lookup: _get_assigned_keys(
+                assigned.filter(content_type=ct_id),
+                ContentType.objects.get_for_id(ct_id).model_class())})
+        if q is None:
+            q = level_q
+        else:
+            q = q | level_q
+    return q
+
+
+def _get_assigned_keys(assigned, model):
+    """
+    Returns the keys of the objects of the given model the given
+    AssignedPermissions are for, as a subquery if it can be compared with
+    the model's primary keys on every database, or else as a list.
+    """
+    
+    field = get_object_field(model)
+    assigned = assigned.filter(**{'%s__isnull' % field: False})
+    if field == 'object_id' or _has_text_pk(model):
+        return assigned.values(field)
+    pk = _get_pk_field(model)
+    return [pk.to_python(key) for key in assigned.values_list(field, flat=True)]
+
+
+def get_assigned_exists_sql(assigned, model, using, include_type=False, alias=None, qn=None):
+    """
+    Returns the SQL and parameters of an ``EXISTS`` clause, for a query on
+    the given model, which is true for rows with an AssignedPermission in the
+    `assigned` QuerySet for that row's object (or for the type, if
+    `include_type` is true).
+    
+    The row's primary key is compared directly with the column holding keys
+    of its type (see `get_object_field`), so the clause can use an index.
+    The rows are those of the model's table, or of the given table `alias`,
+    quoted with `qn` if given.
+    """
+    
+    AssignedPermission = get_model('rubberstamp', 'assignedpermission')
+    quote_name = connections[using].ops.quote_name
+    if qn is None:
+        qn = quote_name
+    if alias is None:
+        alias = model._meta.db_table
+    field = get_object_field(model)
+    object_id = '%s.%s' % (
+        quote_name(AssignedPermission._meta.db_table),
+        quote_name(AssignedPermission._meta.get_field(field).column),
+    )
+    pk_column = '%s.%s' % (qn(alias), qn(model._meta.pk.column))
+    if field == 'object_key':
+        # compared as text, as keys are stored (only PostgreSQL needs a cast)
+        pk_column = connections[using].ops.lookup_cast('contains') % pk_column
+    where = '%s = %s' % (object_id, pk_column)
+    if include_type:
+        where = '(%s OR %s IS NULL)' % (where, object_id)
+    (sql, params) = assigned.extra(where=[where]).values(field).query \
+        .get_compiler(using=using).as_sql()
+    return ('EXISTS (%s)' % sql, params)
+
+
+class AssignedExists(object):
+    """
+    A node for the where clause of a query on the given model, adding the
+    ``EXISTS`` clause of `get_assigned_exists_sql`.
+    
+    Unlike a raw ``extra()`` clause, the node follows the table alias of the
+    query as it is relabelled, e.g. when the query is used as a subquery of
+    another, so the clause stays correlated with the right table.
+    """
+    
+    def __init__(self, assigned, model, alias):
+        self.assigned = assigned
+        self.model = model
+        self.alias = alias
+    
+    def __deepcopy__(self, memo):
+        # the assigned QuerySet isn't changed, only the alias can be
+        return AssignedExists(self.assigned, self.model, self.alias)
+    
+    def as_sql(self, qn, connection):
+        return get_assigned_exists_sql(self.assigned, self.model, connection.alias,
+            alias=self.alias, qn=qn)
+    
+    def relabel_aliases(self, change_map):
+        if self.alias in change_map:
+            self.alias = change_map[self.alias]
+
+
+def get_assigned_for_user(perm, ct, user):
+    """
+    Returns a QuerySet of the AssignedPermissions of the given permission
+    (or of any permission implying it) and type held by the given user,
+    directly or through groups.
+    """
+    
+    return get_model('rubberstamp', 'assignedpermission').objects.filter(
+        get_perm_q_for_user(user),
+        _get_permission_q(perm),
+        content_type=ct
+    )
+
+
+def _get_permission_q(perm):
+    """
+    Returns a Q object matching assignments of the given permission, or of
+    any permission implying it.
+    """
+    
+    from rubberstamp.cache import get_implying_permission_ids
+    perm_ids = get_implying_permission_ids(perm.pk)
+    if len(perm_ids) == 1:
+        return Q(permission=perm)
+    return Q(permission__in=perm_ids)
+
+
+def _has_type_permission(perm, ct, user):
+    """
+    Returns whether the given user has the given permission for the type
+    itself, from the backend's cache if loaded or with a single query.
+    """
+    
+    from rubberstamp.cache import get_cached_user_permissions
+    cached = get_cached_user_permissions(user)
+    if cached is not None:
+        return cached.has_perm(perm.pk, ct.pk)
+    field = get_object_field(ct.model_class())
+    return get_assigned_for_user(perm, ct, user).filter(
+        **{'%s__isnull' % field: True}).exists()
+
+
+def _get_pk_field(model):
+    pk = model._meta.pk
+    while pk.rel:
+        # e.g. the parent link of a multi-table inheritance child
+        pk = pk.rel.get_related_field()
+    return pk
+
+
+def _has_integer_pk(model):
+    """
+    Returns whether the given model's primary key is a positive integer,
+    which fits the ``object_id`` column.
+    """
+    
+    return isinstance(_get_pk_field(model), (models.AutoField,
+        models.PositiveIntegerField, models.PositiveSmallIntegerField))
+
+
+def _has_text_pk(model):
+    """Returns whether the given model's primary key is stored as text."""
+    
+    return isinstance(_get_pk_field(model), (models.CharField, models.TextField))
+
+
+def get_object_field(model):
+    """
+    Returns the name of the `AssignedPermission` field holding the primary
+    keys of objects of the given model: ``object_id`` for positive integer
+    keys, or ``object_key``, holding them as text, for any other (including
+    other integers, which may be negative or too big for ``object_id``).
+    """
     
-    q = Q(
-            permission=perm,
-            content_type=ct,
-            object_id__isnull=False
+    if model is None or _has_integer_pk(model):
+        return 'object_id'
+    return 'object_key'
+
+
+def get_object_value(model, pk):
+    """
+    Returns the given primary key of an object of the given model as stored
+    in the field named by `get_object_field`.
+    """
+    
+    if pk is None or model is None or _has_integer_pk(model):
+        return pk
+    return force_unicode(pk)
+
+
+def has_perm_for_objects(permission, user, objects):
+    """
+    Given a permission string, a user and a list (or QuerySet) of objects of
+    one type, returns a dict mapping the primary key of each object to
+    whether the user has that permission for it.
+    
+    A type-level assignment of the permission counts for every object. Uses
+    a single query per 500 objects, or none if the user's permissions are
+    already cached by the backend. Permissions inherited from ancestors
+    count too (see `get_inherited_q`), which takes another query per 500
+    objects not allowed otherwise, when there is anything to inherit.
+    """
+    
+    AppPermission = get_model('rubberstamp', 'apppermission')
+    (perm, ct, obj_ids) = AppPermission.objects._resolve_many(permission, objects)
+    if not obj_ids:
+        return {}
+    model = ct.model_class()
+    
+    from rubberstamp.cache import get_cached_user_permissions
+    cached = get_cached_user_permissions(user)
+    if cached is not None:
+        if cached.has_perm(perm.pk, ct.pk):
+            return dict([(obj_id, True) for obj_id in obj_ids])
+        return _add_inherited(dict([(obj_id, cached.has_perm(perm.pk, ct.pk, obj_id))
+            for obj_id in obj_ids]), model, perm, user)
+    
+    AssignedPermission = get_model('rubberstamp', 'assignedpermission')
+    field = get_object_field(model)
+    allowed = set()
+    for ids in chunked(obj_ids):
+        ids = [get_object_value(model, obj_id) for obj_id in ids]
+        q = _get_permission_q(perm) & Q(content_type=ct) & (
+            Q(**{'%s__in' % field: ids}) | Q(**{'%s__isnull' % field: True})
         ) & get_perm_q_for_user(user)
+        allowed.update(AssignedPermission.objects.filter(q) \
+            .values_list(field, flat=True).distinct())
+    
+    if None in allowed:
+        return dict([(obj_id, True) for obj_id in obj_ids])
+    return _add_inherited(dict([(obj_id, get_object_value(model, obj_id) in allowed)
+        for obj_id in obj_ids]), model, perm, user)
+
+
+def _add_inherited(allowed, model, perm, user):
+    """
+    Sets to True the values of the given dict, mapping primary keys of
+    objects of the given model to whether they are allowed, for those which
+    inherit the permission from an ancestor (see `get_inherited_q`).
+    """
     
-    obj_ids = get_model('rubberstamp', 'assignedpermission').objects.filter(q).values('object_id')
-    return ct.model_class().objects.filter(pk__in=obj_ids)
+    denied = [obj_id for (obj_id, value) in allowed.items() if not value]
+    if not denied:
+        return allowed
+    inherited = get_inherited_q(model, perm, user)
+    if inherited is None:
+        return allowed
+    for ids in chunked(denied):
+        for obj_id in model._base_manager.filter(inherited, pk__in=ids) \
+                .values_list('pk', flat=True):
+            allowed[obj_id] = True
+    return allowed
+
+
+def filter_allowed(permission, user, objects):
+    """
+    Given a permission string, a user and a list (or QuerySet) of objects of
+    one type, returns a list of those objects for which the user has that
+    permission, in their original order.
+    
+    See ``has_perm_for_objects``.
+    """
+    
+    objects = list(objects)
+    allowed = has_perm_for_objects(permission, user, objects)
+    return [obj for obj in objects if allowed[obj.pk]]
+
+
+def get_parent_field(model):
+    """
+    Returns the foreign key to the parent of objects of the given model, as
+    named in ``RUBBERSTAMP_PERMISSION_PARENTS``, or None.
+    """
+    
+    name = getattr(settings, 'RUBBERSTAMP_PERMISSION_PARENTS', {}).get(
+        '%s.%s' % (model._meta.app_label, model._meta.object_name.lower()))
+    if not name:
+        return None
+    return model._meta.get_field(name)
+
+
+def get_parent_levels(model):
+    """
+    Returns a list of `(lookup, content type id)` pairs for the parent of
+    objects of the given model, its parent's parent, and so on, where
+    `lookup` names the key of that ancestor from the model, like
+    ``'folder__parent'``. Needs no queries once Django's ContentType cache
+    is warm.
+    
+    Parents are followed for at most ``RUBBERSTAMP_PERMISSION_PARENTS_DEPTH``
+    levels (10 by default), so that a model which is its own parent has a
+    bounded number of levels too.
+    """
+    
+    from django.contrib.contenttypes.models import ContentType
+    depth = getattr(settings, 'RUBBERSTAMP_PERMISSION_PARENTS_DEPTH', 10)
+    levels = []
+    names = []
+    field = get_parent_field(model)
+    while field is not None and len(levels) < depth:
+        names.append(field.name)
+        model = field.rel.to
+        levels.append(('__'.join(names), ContentType.objects.get_for_model(model).id))
+        field = get_parent_field(model)
+    return levels
+
+
+def get_parent_content_types(model):
+    """
+    Returns a list of the ids of the content types an object of the given
+    model may inherit permissions from (see `get_parent_levels`).
+    """
+    
+    ct_ids = []
+    for (lookup, ct_id) in get_parent_levels(model):
+        if ct_id not in ct_ids:
+            ct_ids.append(ct_id)
+    return ct_ids
+
+
+def iter_permission_parents(obj):
+    """
+    Yields a `(content type id, primary key)` pair for the parent of the
+    given object, then for its parent's parent, and so on (see
+    `get_parent_levels`).
+    
+    The parent's key is read from the foreign key column of the object, and
+    the keys of all further ancestors with a single query, through the
+    foreign key columns of each level, when iteration goes on past the
+    parent. No ancestor is loaded itself, and the keys are cached on the
+    object while its parent stays the same.
+    """
+    
+    model = type(obj)
+    levels = get_parent_levels(model)
+    if not levels:
+        return
+    parent_pk = getattr(obj, get_parent_field(model).attname)
+    if parent_pk is None:
+        return
+    yield (levels[0][1], parent_pk)
+    
+    if len(levels) > 1:
+        cached = getattr(obj, PARENTS_ATTR, None)
+        if cached is None or cached[0] != parent_pk:
+            keys = list(model._base_manager.filter(pk=obj.pk)
+                .values_list(*[lookup for (lookup, ct_id) in levels[1:]])[:1])
+            cached = (parent_pk, keys and keys[0] or ())
+            setattr(obj, PARENTS_ATTR, cached)
+        for ((lookup, ct_id), pk) in zip(levels[1:], cached[1]):
+            if pk is None:
+                return
+            yield (ct_id, pk)
 
 
 def get_app_list(user):
     AssignedPermission = get_model('rubberstamp', 'assignedpermission')
     return AssignedPermission.objects.filter(get_perm_q_for_user(user)) \
         .values_list('permission__app_label', flat=True).distinct()
+
+
+def get_permission_tree():
+    """
+    Returns every AppPermission, grouped by app, as a list of dicts like::
+        
+        [
+            {
+                'label': 'app_label',
+                'perms': [
+                    {
+                        'codename': 'permission_codename',
+                        'types': [content_type_1, content_type_2, ...],
+                    },
+                    ...
+                ],
+            },
+            ...
+        ]
+    
+    Uses two queries however many permissions there are. With
+    ``RUBBERSTAMP_CACHE_PERMISSION_TREE`` on, the result is kept in Django's
+    cache until permissions or the types they apply to change.
+    """
+    
+    from rubberstamp.cache import PERMISSION_TREE_CACHE_KEY
+    use_cache = getattr(settings, 'RUBBERSTAMP_CACHE_PERMISSION_TREE', False)
+    if use_cache:
+        apps = cache.get(PERMISSION_TREE_CACHE_KEY)
+        if apps is not None:
+            return apps
+    
+    AppPermission = get_model('rubberstamp', 'apppermission')
+    types = {}
+    links = AppPermission.content_types.through.objects.select_related('contenttype') \
+        .order_by('contenttype__app_label', 'contenttype__model')
+    for link in links:
+        types.setdefault(link.apppermission_id, []).append(link.contenttype)
+    
+    on_app = None
+    apps = []
+    for (perm_id, app, codename) in AppPermission.objects \
+            .order_by('app_label', 'codename').values_list('id', 'app_label', 'codename'):
+        if app != on_app:
+            on_app = app
+            # add app and empty perm list
+            apps.append({'label': app, 'perms': []})
+        # add this code to the current app's list
+        apps[-1]['perms'].append({'codename': codename, 'types': types.get(perm_id, [])})
+    
+    if use_cache:
+        cache.set(PERMISSION_TREE_CACHE_KEY, apps)
+    return apps
+
+
+def chunked(seq, size=500):
+    """
+    Yields successive lists of at most `size` items from `seq`, to keep `IN`
+    lists within the limits of every database backend.
+    """
+    
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def bulk_insert(model, rows):
+    """
+    Inserts rows for the given model, each given as a dict of field attnames
+    to values, without loading or saving model instances.
+    
+    Uses `bulk_create` where Django provides it; otherwise a single
+    `executemany` of one INSERT statement. No signals are sent.
+    """
+    
+    if not rows:
+        return
+    if hasattr(model.objects, 'bulk_create'):
+        model.objects.bulk_create([model(**row) for row in rows])
+        return
+    
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    columns = dict([(f.attname, f.column) for f in model._meta.local_fields])
+    attnames = sorted(rows[0].keys())
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(columns[a]) for a in attnames]),
+        ', '.join(['%s'] * len(attnames)),
+    )
+    cursor = connection.cursor()
+    cursor.executemany(sql, [[row[a] for a in attnames] for row in rows])
+    transaction.commit_unless_managed(using=using)
+
+
+def bulk_delete(queryset):
+    """
+    Deletes the rows matched by the given QuerySet, which must filter on
+    columns of its own table only, with a single DELETE statement, and
+    returns the number of rows deleted.
+    
+    Unlike `QuerySet.delete`, no model instances are loaded, no related
+    objects are collected and no signals are sent.
+    """
+    
+    using = queryset.db
+    # as DeleteQuery.do_query, which doesn't return the cursor
+    query = DeleteQuery(queryset.model)
+    query.tables = [queryset.model._meta.db_table]
+    query.where = queryset.query.where
+    cursor = query.get_compiler(using).execute_sql(None)
+    transaction.commit_unless_managed(using=using)
+    return cursor.rowcount
@@ -1,11 +1,18 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import HttpResponse, Http404
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils import simplejson
 
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 
 from rubberstamp.models import AppPermission, AssignedPermission
-from rubberstamp.forms import PermissionAssignForm
+from rubberstamp.forms import PermissionAssignForm, PermissionDeltaForm
+from rubberstamp.utils import get_permission_tree, get_object_field, get_object_value
 
 
 def app_list(request):
@@ -14,7 +21,7 @@ def app_list(request):
     
     Renders the template ``'rubberstamp/app_list.html'``, with context
     containing ``apps``, a list of dicts like::
-    
+        
         [
             {
                 'label': 'app_label',
@@ -30,18 +37,7 @@ def app_list(request):
         ]
     """
     
-    app_perms = AppPermission.objects.order_by('app_label', 'codename')
-    on_app = None
-    apps = []
-    for perm in app_perms:
-        app = perm.app_label
-        if app != on_app:
-            on_app = app
-            # add app and empty perm list
-            apps.append({'label': app, 'perms': []})
-        # add this code to the current app's list
-        apps[-1]['perms'].append(
-            {'codename': perm.codename, 'types': perm.content_types.order_by('app_label', 'model')})
+    apps = get_permission_tree()
     
     return render_to_response(
         'rubberstamp/app_list.html',
@@ -50,18 +46,77 @@ def app_list(request):
     )
 
 
+def _get_search_q(target_ct, query):
+    """
+    Returns a Q object to search objects of the given type for the given
+    string, using the fields configured for that type in
+    ``RUBBERSTAMP_SEARCH_FIELDS``, or None if none are configured.
+    
+    As with ``search_fields`` in Django's admin, a field name may be prefixed
+    with ``^`` for a (case-insensitive) prefix match, which can use an index,
+    or ``=`` for an exact match; otherwise a substring match is used.
+    """
+    
+    search_fields = getattr(settings, 'RUBBERSTAMP_SEARCH_FIELDS', {}).get(
+        '%s.%s' % (target_ct.app_label, target_ct.model))
+    if not search_fields:
+        return None
+    q = Q()
+    for field in search_fields:
+        if field.startswith('^'):
+            lookup = '%s__istartswith' % field[1:]
+        elif field.startswith('='):
+            lookup = '%s__iexact' % field[1:]
+        else:
+            lookup = '%s__icontains' % field
+        q = q | Q(**{lookup: query})
+    return q
+
+
+def _iter_pages(queryset, size):
+    """
+    Yields successive lists of at most `size` objects from the given
+    QuerySet, paging on the primary key so each page is a cheap index range
+    scan and only one page is held in memory at a time.
+    """
+    
+    after = None
+    while True:
+        page = queryset
+        if after is not None:
+            page = page.filter(pk__gt=after)
+        page = list(page[:size])
+        if not page:
+            return
+        yield page
+        after = page[-1].pk
+
+
 def object_list(request, app, code, target_app, target_model):
     """
     Given an app label and permission codename, as well as a "target" app label
     and model name, returns a list of objects of the target type to which the
     permission can apply.
     
+    Objects are ordered by primary key, and paged on it: a page holds
+    ``RUBBERSTAMP_OBJECTS_PER_PAGE`` objects (100 by default), starting after
+    the primary key given as the ``after`` GET parameter. If search fields are
+    configured for the type in ``RUBBERSTAMP_SEARCH_FIELDS``, only objects
+    matching the ``q`` GET parameter are listed.
+    
     Renders the template ``'rubberstamp/object_list.html'``, with context
     containing the following::
     
     * ``perm``, the `AppPermission` instance
     * ``type``, the `ContentType` of the objects
-    * ``objects``, a list of instances of the appropriate type
+    * ``objects``, a list of instances of the appropriate type (one page)
+    * ``next_after``, the ``after`` parameter of the next page, or None if
+      this is the last page
+    * ``query``, the search string
+    
+    If the ``stream`` GET parameter is given, all (matching) objects are
+    streamed instead, a page at a time, each page rendered with the template
+    ``'rubberstamp/object_list_page.html'`` and the same context.
     """
     
     target_ct = get_object_or_404(
@@ -69,12 +124,49 @@ def object_list(request, app, code, target_app, target_model):
     perm = get_object_or_404(AppPermission,
         app_label=app, codename=code, content_types=target_ct)
     TargetClass = target_ct.model_class()
+    per_page = getattr(settings, 'RUBBERSTAMP_OBJECTS_PER_PAGE', 100)
+    
+    objects = TargetClass.objects.order_by('pk')
+    query = request.GET.get('q', '')
+    if query:
+        search_q = _get_search_q(target_ct, query)
+        if search_q:
+            objects = objects.filter(search_q)
+    
+    if 'stream' in request.GET:
+        def render_pages():
+            for page in _iter_pages(objects, per_page):
+                yield render_to_string(
+                    'rubberstamp/object_list_page.html',
+                    {
+                        'perm': perm,
+                        'type': target_ct,
+                        'objects': page,
+                        'query': query,
+                    },
+                    RequestContext(request)
+                )
+        return HttpResponse(render_pages())
+    
+    after = request.GET.get('after')
+    if after:
+        try:
+            objects = objects.filter(pk__gt=TargetClass._meta.pk.to_python(after))
+        except ValidationError:
+            raise Http404
+    page = list(objects[:per_page + 1])
+    next_after = None
+    if len(page) > per_page:
+        page = page[:per_page]
+        next_after = page[-1].pk
     return render_to_response(
         'rubberstamp/object_list.html',
         {
             'perm': perm,
             'type': target_ct,
-            'objects': TargetClass.objects.all(),
+            'objects': page,
+            'next_after': next_after,
+            'query': query,
         },
         RequestContext(request)
     )
@@ -99,6 +191,11 @@ def type_perms(request, app, code, target_app, target_model, obj_pk=None):
     If an object is specific, the context will also include:
     
     * ``object``, the object
+    
+    With ``RUBBERSTAMP_DELTA_ASSIGNMENT`` on, ``assign_form`` is instead a
+    `PermissionDeltaForm`, which takes only the users and groups to add and
+    remove, and the context also includes ``assigned_users`` and
+    ``assigned_groups``, QuerySets of the current assignees.
     """
     
     target_ct = get_object_or_404(
@@ -108,23 +205,47 @@ def type_perms(request, app, code, target_app, target_model, obj_pk=None):
     TargetClass = target_ct.model_class()
     
     if obj_pk:
+        try:
+            obj_pk = TargetClass._meta.pk.to_python(obj_pk)
+        except (ValidationError, ValueError):
+            raise Http404
         obj = get_object_or_404(TargetClass, pk=obj_pk)
     else:
         obj = None
     
-    perm_name = '%s.%s.%s.%s' % (app, code, target_app, target_model)
+    object_field = get_object_field(TargetClass)
     perm_filter = {
         'permission': perm,
         'content_type': target_ct,
-        'object_id': obj_pk
+        object_field: None
     }
+    if obj:
+        perm_filter[object_field] = get_object_value(TargetClass, obj.pk)
     perms = AssignedPermission.objects.filter(
         **perm_filter).select_related('user', 'group')
     
-    current_users = set(User.objects.filter(
-        id__in=perms.filter(user__isnull=False).values_list('user')))
-    current_groups = set(Group.objects.filter(
-        id__in=perms.filter(group__isnull=False).values_list('group')))
+    context_dict = {
+        'perm': perm,
+        'type': target_ct,
+    }
+    if obj:
+        context_dict['object'] = obj
+    if getattr(settings, 'RUBBERSTAMP_DELTA_ASSIGNMENT', False):
+        context_dict.update(_assign_delta(request, perm, target_ct, perms, obj))
+        return render_to_response(
+            'rubberstamp/type_perms.html',
+            context_dict,
+            RequestContext(request)
+        )
+    
+    # load the current users and groups with a single query
+    current_users = set()
+    current_groups = set()
+    for assigned in perms:
+        if assigned.user_id is not None:
+            current_users.add(assigned.user)
+        else:
+            current_groups.add(assigned.group)
     initial = {
         'users': list(current_users),
         'groups': list(current_groups)
@@ -134,25 +255,68 @@ def type_perms(request, app, code, target_app, target_model, obj_pk=None):
         if assign_form.is_valid():
             selected_users = set(assign_form.cleaned_data['users'])
             selected_groups = set(assign_form.cleaned_data['groups'])
-            for user in selected_users - current_users:
-                AppPermission.objects.assign(perm_name, user, obj=obj)
-            for group in selected_groups - current_groups:
-                AppPermission.objects.assign(perm_name, group, obj=obj)
-            for user in current_users - selected_users:
-                AppPermission.objects.remove(perm_name, user, obj=obj)
-            for group in current_groups - selected_groups:
-                AppPermission.objects.remove(perm_name, group, obj=obj)
+            AppPermission.objects.update_assignments(perm, target_ct,
+                add=list(selected_users - current_users) + list(selected_groups - current_groups),
+                remove=list(current_users - selected_users) + list(current_groups - selected_groups),
+                obj=obj)
     else:
         assign_form = PermissionAssignForm(initial=initial)
-    context_dict = {
-        'perm': perm,
-        'type': target_ct,
-        'assign_form': assign_form,
-    }
-    if obj:
-        context_dict['object'] = obj
+    context_dict['assign_form'] = assign_form
     return render_to_response(
         'rubberstamp/type_perms.html',
         context_dict,
         RequestContext(request)
     )
+
+
+def _assign_delta(request, perm, target_ct, perms, obj):
+    """
+    Handles a `PermissionDeltaForm` for ``type_perms``, and returns the
+    context for it. Current assignees are never loaded in full, only handed
+    to the template as QuerySets.
+    """
+    
+    if request.method == 'POST':
+        assign_form = PermissionDeltaForm(request.POST)
+        if assign_form.is_valid():
+            data = assign_form.cleaned_data
+            AppPermission.objects.update_assignments(perm, target_ct,
+                add=list(data['add_users']) + list(data['add_groups']),
+                remove=list(data['remove_users']) + list(data['remove_groups']),
+                obj=obj)
+    else:
+        assign_form = PermissionDeltaForm()
+    return {
+        'assign_form': assign_form,
+        'assigned_users': User.objects.filter(
+            id__in=perms.filter(user__isnull=False).values('user')).order_by('username'),
+        'assigned_groups': Group.objects.filter(
+            id__in=perms.filter(group__isnull=False).values('group')).order_by('name'),
+    }
+
+
+def principal_lookup(request, kind):
+    """
+    Returns a JSON list of users or groups (depending on `kind`, either
+    ``'users'`` or ``'groups'``) whose username or name starts with the ``q``
+    GET parameter, for building the selection of a `PermissionDeltaForm`.
+    
+    Each item is a dict with ``id`` and ``name``. At most
+    ``RUBBERSTAMP_LOOKUP_LIMIT`` (20 by default) are returned, ordered by
+    name; the case-sensitive prefix match can use the name's index.
+    """
+    
+    if kind == 'users':
+        (model, field) = (User, 'username')
+    elif kind == 'groups':
+        (model, field) = (Group, 'name')
+    else:
+        raise Http404
+    limit = getattr(settings, 'RUBBERSTAMP_LOOKUP_LIMIT', 20)
+    query = request.GET.get('q', '')
+    principals = model.objects.filter(**{'%s__startswith' % field: query}) \
+        .order_by(field).values_list('id', field)[:limit]
+    return HttpResponse(
+        simplejson.dumps([{'id': pk, 'name': name} for (pk, name) in principals]),
+        mimetype='application/json'
+    )